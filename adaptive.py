@@ -0,0 +1,168 @@
+"""
+Adaptive early-stopping evaluation. Examples are drawn in a stratified random order (by topic)
+and evaluated in batches ("looks"); after each look the stratified estimate of the target metric
+and its confidence interval are updated, and evaluation stops as soon as the interval half-width
+is below the target or the budget is spent. The interval is Bonferroni-corrected over the maximum
+number of looks, so it keeps its stated coverage however early the run stops.
+"""
+import ast
+import math
+import random
+from pathlib import Path
+from statistics import NormalDist
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from classes import SamplerBase
+from grade_cache import GradeCache
+from simpleqa_eval import GRADER_PREFIX, SimpleQAEval, record_key, records_by_key
+
+ADAPTIVE_METRICS = ["is_correct", "accuracy_given_attempted"]
+
+
+def example_strata(examples: Sequence, field: str = "topic") -> List[str]:
+    metadata = [example["metadata"] for example in examples]
+    metadata = [ast.literal_eval(m) if isinstance(m, str) else m for m in metadata]
+    return [str(m.get(field)) for m in metadata]
+
+
+def stratified_order(strata: List[str], seed: int = 0) -> List[int]:
+    """
+    Random order of the indices in which every prefix holds each stratum in close to its
+    population proportion: the j-th of a stratum's n shuffled members is placed at (j + u) / n.
+    """
+    rng = random.Random(seed)
+    members = {}
+    for i, stratum in enumerate(strata):
+        members.setdefault(stratum, []).append(i)
+    keyed = []
+    for stratum in sorted(members):
+        indices = members[stratum]
+        rng.shuffle(indices)
+        offset = rng.random()
+        keyed.extend(((j + offset) / len(indices), rng.random(), i) for j, i in enumerate(indices))
+    return [i for _, _, i in sorted(keyed)]
+
+
+def stratified_estimate(
+    values: np.ndarray,
+    strata: List[str],
+    population: Dict[str, int]
+) -> Tuple[float, float]:
+    """
+    Stratified mean of `values` (a sample of the population) and its variance, with a
+    finite population correction per stratum. Strata with one sampled value contribute no variance.
+    """
+    strata = np.asarray(strata)
+    total = sum(population.values())
+    mean, variance = 0.0, 0.0
+    for stratum in np.unique(strata):
+        sample = values[strata == stratum]
+        weight = population[stratum] / total
+        mean += weight * sample.mean()
+        if len(sample) > 1:
+            fpc = 1 - len(sample) / population[stratum]
+            variance += weight ** 2 * sample.var(ddof=1) / len(sample) * fpc
+    # Unsampled strata are absent from the estimate; rescale to the sampled part of the population
+    covered = sum(population[stratum] for stratum in np.unique(strata)) / total
+    return mean / covered, variance / covered ** 2
+
+
+def metric_interval(
+    grades: List[Dict],
+    strata: List[str],
+    population: Dict[str, int],
+    metric: str,
+    z: float
+) -> Tuple[float, float]:
+    """
+    Stratified estimate of `metric` and the half-width of its z-interval. The ratio
+    accuracy_given_attempted is linearized (delta method) around the estimate.
+    """
+    is_correct = np.array([grade["metrics"]["is_correct"] for grade in grades], dtype=float)
+    if metric == "is_correct":
+        estimate, variance = stratified_estimate(is_correct, strata, population)
+        n = len(grades)
+    else:
+        attempted = 1 - np.array([grade["metrics"]["is_not_attempted"] for grade in grades], dtype=float)
+        correct_rate, _ = stratified_estimate(is_correct, strata, population)
+        attempted_rate, _ = stratified_estimate(attempted, strata, population)
+        if attempted_rate == 0:
+            return 0.0, math.inf
+        estimate = correct_rate / attempted_rate
+        _, variance = stratified_estimate((is_correct - estimate * attempted) / attempted_rate, strata, population)
+        n = int(attempted.sum())
+    # A sample of all-correct (or all-wrong) answers has zero variance; floor it with the
+    # variance of the Laplace-smoothed proportion so a lucky first look cannot stop the run
+    smoothed = (estimate * n + 1) / (n + 2)
+    fpc = 1 - len(grades) / sum(population.values())
+    variance = max(variance, smoothed * (1 - smoothed) / max(n, 1) * fpc)
+    return estimate, z * math.sqrt(variance)
+
+
+def run_adaptive(
+    model: SamplerBase,
+    grader_model: SamplerBase,
+    target_half_width: float = 0.02,
+    metric: str = "is_correct",
+    look_size: int = 200,
+    budget: Union[int, None] = None,
+    alpha: float = 0.05,
+    seed: int = 0,
+    responses_file: Union[str, Path, None] = None,
+    grades_file: Union[str, Path, None] = None,
+    grading_mode: str = "generate",
+    grade_cache: Union[GradeCache, None] = None,
+    pregrade: bool = False
+) -> Tuple[List[Dict], Dict[str, float]]:
+    """
+    Evaluate batches of `look_size` examples in stratified random order until the (1 - alpha)
+    interval on `metric` is at most `target_half_width` wide on each side, or `budget` examples
+    are evaluated. Returns the evaluated responses and the sequential estimate's metrics.
+    Responses and grades are streamed to their files, so a rerun resumes where it stopped.
+    """
+    assert metric in ADAPTIVE_METRICS, f"Unknown {metric=}"
+    examples = SimpleQAEval.get_examples()
+    strata = example_strata(examples)
+    population = {stratum: strata.count(stratum) for stratum in set(strata)}
+    order = stratified_order(strata, seed)
+    budget = min(budget or len(order), len(order))
+    max_looks = math.ceil(budget / look_size)
+    # Bonferroni over every look the run may take
+    z = NormalDist().inv_cdf(1 - alpha / (2 * max_looks))
+
+    # Read the files and cache the grader prefix once, so each look only costs its own batch
+    done = records_by_key(responses_file)
+    graded = records_by_key(grades_file)
+    if grader_model is not None:
+        grader_model.cache_prefix(GRADER_PREFIX)
+
+    responses, grades = [], []
+    estimate, half_width = math.nan, math.inf
+    looks = 0
+    while len(responses) < budget and half_width > target_half_width:
+        batch = order[len(responses):min(len(responses) + look_size, budget)]
+        batch_responses = SimpleQAEval.generate_responses(
+            model, output_file=responses_file, examples=[examples[i] for i in batch], done=done
+        )
+        SimpleQAEval.grade_all(
+            grader_model, batch_responses, grading_mode, grades_file, grade_cache, pregrade,
+            graded=graded, prefix_cached=True
+        )
+        responses.extend(batch_responses)
+        grades.extend(graded[record_key(response)] for response in batch_responses)
+        looks += 1
+
+        sampled_strata = [strata[i] for i in order[:len(responses)]]
+        estimate, half_width = metric_interval(grades, sampled_strata, population, metric, z)
+        print(f"Look {looks}/{max_looks}: {len(responses)} examples, {metric} = {estimate:.4f} ± {half_width:.4f}")
+
+    return responses, {
+        f"{metric}:sequential": estimate,
+        f"{metric}:sequential_ci_low": max(0.0, estimate - half_width),
+        f"{metric}:sequential_ci_high": min(1.0, estimate + half_width),
+        "adaptive_examples": len(responses),
+        "adaptive_looks": looks,
+        "adaptive_stopped_early": half_width <= target_half_width and len(responses) < len(order),
+    }
@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Tuple
+
+from classes import MessageList, SamplerBase, SamplerResponse
+
+
+class _Request:
+    def __init__(self, kind: str, payload: Any, key: Any = None):
+        self.kind = kind
+        self.payload = payload
+        self.key = key
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+
+class BatchingSampler(SamplerBase):
+    """
+    Thread-safe front end for a sampler. Concurrent calls from any number of threads are queued and
+    collected into micro-batches of at most `max_batch_size` requests, waiting at most `max_wait_ms`
+    for a batch to fill. A single worker thread runs each micro-batch through the wrapped sampler's
+    batched API and hands every result back to the thread that asked for it.
+    """
+
+    def __init__(self, sampler: SamplerBase, max_batch_size: int = 8, max_wait_ms: float = 10.0):
+        self.sampler = sampler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def __getattr__(self, name: str):
+        # Expose the wrapped sampler's helpers (e.g. _pack_message)
+        if name == "sampler":
+            raise AttributeError(name)
+        return getattr(self.sampler, name)
+
+    def _submit(self, kind: str, payload: Any, key: Any = None) -> Future:
+        request = _Request(kind, payload, key)
+        self._queue.put(request)
+        return request.future
+
+    def _collect(self, first: _Request) -> Tuple[List[_Request], bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stop = self._collect(first)
+
+            # Only requests of the same kind (and choices, for scoring) can share a forward pass
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.kind, request.key), []).append(request)
+            for (kind, key), requests in groups.items():
+                self._run_group(kind, key, requests)
+
+    def _run_group(self, kind: str, key: Any, requests: List[_Request]):
+        start = time.perf_counter()
+        try:
+            if kind == "sample":
+                results = self.sampler.sample_batch([request.payload for request in requests])
+            elif kind == "score":
+                results = self.sampler.score_choices_batch_with_metadata(
+                    [request.payload for request in requests], list(key)
+                )
+            elif kind == "prefix":
+                results = [self.sampler.cache_prefix(request.payload) for request in requests]
+            else:
+                raise ValueError(f"Unknown request {kind=}")
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        for request, result in zip(requests, results):
+            if isinstance(result, SamplerResponse):
+                result.response_metadata["queue_time"] = start - request.submitted
+            elif kind == "score":
+                result[1]["queue_time"] = start - request.submitted
+            request.future.set_result(result)
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        return self._submit("sample", message_list).result()
+
+    def imap_batch(self, message_lists: List[MessageList]) -> Iterator[Tuple[int, SamplerResponse]]:
+        futures = [self._submit("sample", message_list) for message_list in message_lists]
+        for i, future in enumerate(futures):
+            yield i, future.result()
+
+    def score_choices(self, message_list: MessageList, choices: List[str]) -> List[float]:
+        return self._submit("score", message_list, tuple(choices)).result()[0]
+
+    def score_choices_batch_with_metadata(
+        self, message_lists: List[MessageList], choices: List[str]
+    ) -> List[Tuple[List[float], Dict[str, Any]]]:
+        futures = [self._submit("score", message_list, tuple(choices)) for message_list in message_lists]
+        return [future.result() for future in futures]
+
+    def score_choices_batch(self, message_lists: List[MessageList], choices: List[str]) -> List[List[float]]:
+        return [probs for probs, _ in self.score_choices_batch_with_metadata(message_lists, choices)]
+
+    def cache_identity(self) -> Dict[str, Any]:
+        return self.sampler.cache_identity()
+
+    def cache_prefix(self, prefix: str) -> None:
+        # Runs on the worker thread so it never races a batch in flight
+        self._submit("prefix", prefix).result()
+
+    def close(self):
+        """
+        Stop the worker thread once the requests already queued have been served.
+        """
+        self._queue.put(None)
+        self._worker.join()
+
+    def unload(self) -> None:
+        self.close()
+        self.sampler.unload()
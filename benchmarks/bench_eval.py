@@ -0,0 +1,187 @@
+"""
+End-to-end throughput benchmark of the eval harness, CPU-only and offline.
+
+    python -m benchmarks.bench_eval --output bench.json [--compare baseline.json]
+
+Runs generate_responses, evaluate, aggregate_results and the report on a synthetic dataset with a
+tiny randomly initialized model (see benchmarks/fixtures.py) and writes one JSON document with
+examples/s, tokens/s, p50/p95 per-example latency and peak RSS for each stage.
+"""
+import os
+
+# Never touch the network, whatever the caller's environment says
+os.environ["HF_HUB_OFFLINE"] = "1"
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+import io
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+import transformers
+
+import columnar
+import common
+import results_store
+from batching_sampler import BatchingSampler
+from benchmarks.fixtures import make_dataset, make_tiny_model
+from hf_chat_completion_sampler import HFChatCompletionSampler
+from simpleqa_eval import SimpleQAEval, record_key
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _stage(seconds: float, num_examples: int, latencies: List[float] = (), **extra) -> Dict[str, float]:
+    stats = {"seconds": seconds, "examples": num_examples, "examples_per_s": num_examples / seconds}
+    if len(latencies):
+        stats["latency_p50"] = float(np.percentile(latencies, 50))
+        stats["latency_p95"] = float(np.percentile(latencies, 95))
+    return stats | extra | {"peak_rss_mb": _peak_rss_mb()}
+
+
+def _environment() -> Dict[str, str]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def run_benchmarks(args) -> Dict:
+    torch.set_num_threads(args.threads)
+    work_dir = Path(args.work_dir)
+    dataset_path = make_dataset(work_dir / f"simpleqa_synthetic_{args.num_examples}.csv", args.num_examples, args.seed)
+    model_dir = make_tiny_model(work_dir / "tiny_model", dataset_path, seed=args.seed)
+    SimpleQAEval.load_dataset(dataset_path, work_dir / "dataset_cache")
+    stages = {}
+
+    sampler = HFChatCompletionSampler(
+        model=None, model_dir=str(model_dir), device="cpu", max_tokens=args.max_tokens,
+        temperature=1.0, batch_size=args.batch_size, dtype=args.dtype, quantize=args.quantize
+    )
+    # Seeded after the fixtures so a freshly built and a reused model sample the same tokens
+    torch.manual_seed(args.seed)
+    responses_file = work_dir / "responses.jsonl"
+    responses_file.unlink(missing_ok=True)
+    start = time.perf_counter()
+    responses = SimpleQAEval.generate_responses(sampler, output_file=responses_file)
+    seconds = time.perf_counter() - start
+    # Examples of one batch all share the batch's latency
+    latencies = [r["response_metadata"]["latency"] for r in responses]
+    output_tokens = sum(r["response_metadata"]["completion_tokens"] for r in responses)
+    stages["generate_responses"] = _stage(
+        seconds, len(responses), latencies,
+        output_tokens=output_tokens, output_tokens_per_s=output_tokens / seconds
+    )
+
+    # The same tiny model grades, through the micro-batching scheduler like the CLI
+    grader_sampler = HFChatCompletionSampler(
+        model=None, model_dir=str(model_dir), device="cpu", max_tokens=args.grader_max_tokens,
+        temperature=1.0, batch_size=args.batch_size
+    )
+    grader = BatchingSampler(grader_sampler, max_batch_size=args.batch_size)
+    grades_file = work_dir / "grades.jsonl"
+    grades_file.unlink(missing_ok=True)
+    start = time.perf_counter()
+    eval_result = SimpleQAEval.evaluate(
+        grader, responses, grading_mode=args.grading_mode, grades_file=grades_file,
+        n_bootstrap=args.n_bootstrap
+    )
+    seconds = time.perf_counter() - start
+    grader.close()
+    grades = {record_key(grade): grade for grade in common.read_jsonl(grades_file)}
+    latencies = [
+        grade["grader_metadata"].get("queue_time", 0) + grade["grader_metadata"]["latency"]
+        for grade in grades.values() if grade["grader_metadata"]
+    ]
+    stages["evaluate"] = _stage(seconds, len(responses), latencies)
+
+    # Repeat the graded examples to reach a size where aggregation time is measurable
+    repeated = (responses * (args.aggregate_size // len(responses) + 1))[:args.aggregate_size]
+    results = [SimpleQAEval.single_eval_result(r, grades[record_key(r)]) for r in repeated]
+    start = time.perf_counter()
+    common.aggregate_results(results)
+    stages["aggregate_results"] = _stage(time.perf_counter() - start, len(results))
+    start = time.perf_counter()
+    SimpleQAEval.aggregate(results, groups=SimpleQAEval.metadata_groups(repeated), n_bootstrap=args.n_bootstrap)
+    stages["aggregate"] = _stage(time.perf_counter() - start, len(results), n_bootstrap=args.n_bootstrap)
+
+    # The report is rendered from the results table, as the CLI does
+    start = time.perf_counter()
+    table_dir = results_store.write_results_table(work_dir / "results_table", responses, grades.values())
+    report = io.StringIO()
+    common.write_report(
+        report, eval_result.score, eval_result.metrics, results_store.example_htmls(columnar.read_table(table_dir))
+    )
+    stages["make_report"] = _stage(time.perf_counter() - start, len(responses), report_bytes=len(report.getvalue()))
+
+    return {"config": vars(args), "environment": _environment(), "stages": stages}
+
+
+def compare(current: Dict, baseline: Dict):
+    """
+    Print the ratio current/baseline of every throughput and latency figure.
+    """
+    print(f"{'stage':<20} {'metric':<22} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for stage, metrics in current["stages"].items():
+        for name, value in metrics.items():
+            base = baseline["stages"].get(stage, {}).get(name)
+            if base and (name.endswith("_per_s") or name.startswith(("latency", "peak_rss"))):
+                print(f"{stage:<20} {name:<22} {base:>12.4g} {value:>12.4g} {value / base:>8.2f}")
+
+
+def main():
+    parser = ArgumentParser(description="Throughput benchmark of the SimpleQA eval harness")
+    parser.add_argument("--num_examples", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_tokens", type=int, default=32)
+    parser.add_argument("--grader_max_tokens", type=int, default=4)
+    parser.add_argument("--grading_mode", type=str, choices=["generate", "logits"], default="generate")
+    parser.add_argument("--aggregate_size", type=int, default=10000)
+    parser.add_argument("--n_bootstrap", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--dtype", type=str, choices=["float32", "bfloat16", "float16"], default=None)
+    parser.add_argument("--quantize", type=str, choices=["int8"], default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work_dir", type=str, default=os.path.join(tempfile.gettempdir(), "simpleqa_benchmarks"))
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--compare", type=Path, default=None)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    results["config"] = {k: str(v) if isinstance(v, Path) else v for k, v in results["config"].items()}
+    text = json.dumps(results, indent=4)
+    if args.output:
+        args.output.write_text(text)
+        print(f"Wrote benchmark results to {args.output}")
+    else:
+        print(text)
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Offline fixtures for the benchmarks: a synthetic SimpleQA-shaped dataset and a tiny randomly
+initialized causal LM with a tokenizer trained on it, both built locally and deterministically.
+"""
+import csv
+import random
+from pathlib import Path
+from typing import Union
+
+from simpleqa_eval import GRADER_TEMPLATE
+
+TOPICS = ["Science and technology", "Geography", "Sports", "Art", "Music", "History", "Politics", "TV shows"]
+ANSWER_TYPES = ["Person", "Place", "Date", "Number", "Other"]
+WORDS = [
+    "river", "award", "college", "tournament", "museum", "island", "novel", "album", "bridge", "festival",
+    "mountain", "church", "station", "league", "painting", "treaty", "dynasty", "theorem", "satellite", "opera",
+]
+NAMES = ["Michio Sugeno", "Annick Bricaud", "Adolf Anderssen", "Henrich Heine", "Ada Lovelace", "Ibn Battuta"]
+
+
+def _answer(rng: random.Random, answer_type: str) -> str:
+    if answer_type == "Person":
+        return rng.choice(NAMES)
+    if answer_type == "Date":
+        return f"{rng.randint(1, 28)} {rng.choice(['January', 'March', 'July', 'October'])} {rng.randint(1800, 2023)}"
+    if answer_type == "Number":
+        return str(rng.randint(1, 100000))
+    return " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 3)))
+
+
+def make_dataset(path: Union[str, Path], num_examples: int, seed: int = 0) -> Path:
+    """
+    Write a CSV with the SimpleQA columns (metadata, problem, answer) and `num_examples` rows.
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as fh:
+        writer = csv.DictWriter(fh, fieldnames=["metadata", "problem", "answer"])
+        writer.writeheader()
+        for i in range(num_examples):
+            topic, answer_type = rng.choice(TOPICS), rng.choice(ANSWER_TYPES)
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+            writer.writerow({
+                "metadata": repr({"topic": topic, "answer_type": answer_type, "urls": [f"https://example.org/{i}"]}),
+                "problem": f"Question {i}: which {words} was first recorded by {rng.choice(NAMES)}?",
+                "answer": _answer(rng, answer_type),
+            })
+    return path
+
+
+def make_tiny_model(
+    directory: Union[str, Path],
+    corpus_path: Union[str, Path],
+    vocab_size: int = 1000,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    seed: int = 0
+) -> Path:
+    """
+    Save a randomly initialized Llama-architecture model and a byte-level BPE tokenizer trained on
+    the dataset at `corpus_path` and the grader template to `directory`. Reused if it already exists.
+    """
+    directory = Path(directory)
+    if (directory / "config.json").exists():
+        return directory
+
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<unk>", "<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False
+    )
+    corpus = [Path(corpus_path).read_text(encoding="utf-8"), GRADER_TEMPLATE]
+    tokenizer.train_from_iterator(corpus, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+    tokenizer.save_pretrained(directory)
+
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id
+    )
+    torch.manual_seed(seed)
+    LlamaForCausalLM(config).save_pretrained(directory)
+    return directory
@@ -0,0 +1,81 @@
+"""
+Cascaded grading: graders ordered by cost, each loaded only when the first response reaches it.
+Every response is scored by the cheapest grader first and moves on to the next one only while the
+grader's highest A/B/C probability stays below the confidence threshold (see
+SimpleQAEval.grade_cascade). A deterministic sample of the responses resolved early is also graded
+by the last grader, to measure how often the cheaper tiers agree with it.
+"""
+import hashlib
+import threading
+from typing import Any, Callable, Dict, List, Union
+
+from classes import SamplerBase
+
+
+class CascadeGrader:
+    """
+    `loaders[i]` loads the grader of tier `i` (named `names[i]`), cheapest first. A tier's grade
+    stands when its confidence is at least `threshold`; the last tier always decides. A fraction
+    `audit_fraction` of the responses resolved before the last tier are audited by it. `identities`
+    describe the tiers' graders for grade cache keys (default: their names), since the graders
+    themselves are only loaded when needed.
+    """
+
+    def __init__(
+        self,
+        loaders: List[Callable[[], SamplerBase]],
+        names: List[str],
+        threshold: float = 0.9,
+        audit_fraction: float = 0.05,
+        identities: Union[List[Dict[str, Any]], None] = None
+    ):
+        assert len(loaders) == len(names) and loaders, "a cascade needs one name per grader"
+        self.loaders = loaders
+        self.names = names
+        self.threshold = threshold
+        self.audit_fraction = audit_fraction
+        self.identities = identities or [{"model": name} for name in names]
+        self.model_name = f"cascade({','.join(names)};threshold={threshold})"
+        self._graders: List[Union[SamplerBase, None]] = [None] * len(loaders)
+        self._locks = [threading.Lock() for _ in loaders]
+        self._prefix = None
+
+    def __len__(self) -> int:
+        return len(self.loaders)
+
+    def cache_identity(self) -> Dict[str, Any]:
+        return {"cascade": self.identities, "threshold": self.threshold, "audit_fraction": self.audit_fraction}
+
+    def tier(self, i: int) -> SamplerBase:
+        """
+        The grader of tier `i`, loaded on first use.
+        """
+        with self._locks[i]:
+            if self._graders[i] is None:
+                print(f"Loading cascade tier {i}: {self.names[i]}")
+                grader = self.loaders[i]()
+                if self._prefix is not None:
+                    grader.cache_prefix(self._prefix)
+                self._graders[i] = grader
+            return self._graders[i]
+
+    def audited(self, key: str) -> bool:
+        """
+        Whether the response with record key `key` is in the audit sample (stable across runs).
+        """
+        digest = hashlib.sha256(key.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64 < self.audit_fraction
+
+    def loaded_tiers(self) -> List[int]:
+        return [i for i, grader in enumerate(self._graders) if grader is not None]
+
+    def cache_prefix(self, prefix: str) -> None:
+        # Applied to the tiers already loaded and to every tier loaded later
+        self._prefix = prefix
+        for i in self.loaded_tiers():
+            self._graders[i].cache_prefix(prefix)
+
+    def unload(self) -> None:
+        for i in self.loaded_tiers():
+            self._graders[i].unload()
+            self._graders[i] = None
@@ -1,19 +1,93 @@
 from dataclasses import dataclass, field
-from typing import Union, List, Dict, Any
+from typing import Union, List, Dict, Any, Iterator, Tuple
 
 Message = dict[str, Any]  # keys role, content
 MessageList = List[Message]
 
 
+@dataclass
+class SamplerResponse:
+    """
+    A sampled response, with what it cost to produce in `response_metadata`: token counts
+    (prompt_tokens, completion_tokens) and times in seconds (queue_time, prefill_time,
+    decode_time, latency), as far as the sampler can measure them.
+    """
+
+    response_text: str
+    response_metadata: Dict[str, Any] = field(default_factory=dict)
+
+
 class SamplerBase:
     """
     Base class for defining a sampling model, which can be evaluated,
     or used as part of the grading process.
     """
 
-    def __call__(self, message_list: MessageList) -> str:
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        raise NotImplementedError
+
+    def imap_batch(self, message_lists: List[MessageList]) -> Iterator[Tuple[int, SamplerResponse]]:
+        """
+        Yield (index, response) pairs for a list of conversations as they complete.
+        Samplers that can batch requests may yield out of input order.
+        """
+        for i, message_list in enumerate(message_lists):
+            yield i, self(message_list)
+
+    def sample_batch(self, message_lists: List[MessageList]) -> List[SamplerResponse]:
+        """
+        Sample a response for each conversation, returned in input order.
+        """
+        responses = [None] * len(message_lists)
+        for i, response in self.imap_batch(message_lists):
+            responses[i] = response
+        return responses
+
+    def cache_identity(self) -> Dict[str, Any]:
+        """
+        What determines the sampler's outputs (model, precision, sampling settings), as JSON-able
+        values, so cached grades are only reused by an equivalent grader.
+        """
+        return {"model": getattr(self, "model_name", type(self).__name__)}
+
+    def cache_prefix(self, prefix: str) -> None:
+        """
+        Hint that upcoming user messages start with `prefix`, so samplers that support it
+        can precompute and reuse the prefix state. No-op by default.
+        """
+        pass
+
+    def score_choices(self, message_list: MessageList, choices: List[str]) -> List[float]:
+        """
+        Return the probability of each choice being the next token of the response,
+        normalized over the given choices.
+        """
         raise NotImplementedError
 
+    def score_choices_batch(self, message_lists: List[MessageList], choices: List[str]) -> List[List[float]]:
+        return [self.score_choices(message_list, choices) for message_list in message_lists]
+
+    def score_choices_batch_with_metadata(
+        self, message_lists: List[MessageList], choices: List[str]
+    ) -> List[Tuple[List[float], Dict[str, Any]]]:
+        """
+        Like score_choices_batch, pairing each prompt's probabilities with the cost of its scoring
+        pass in the form of a response's metadata (prompt tokens, latency). Empty by default.
+        """
+        return [(probs, {}) for probs in self.score_choices_batch(message_lists, choices)]
+
+    def score_choices_with_metadata(
+        self, message_list: MessageList, choices: List[str]
+    ) -> Tuple[List[float], Dict[str, Any]]:
+        return self.score_choices_batch_with_metadata([message_list], choices)[0]
+
+    def unload(self) -> None:
+        """
+        Release the sampler's resources (model memory, connections) so another model can be loaded.
+        The sampler cannot be used afterwards. No-op by default.
+        """
+        pass
+
 
 @dataclass
 class EvalResult:
@@ -0,0 +1,91 @@
+"""
+A minimal on-disk columnar format: one directory per table, with each string column stored as a
+flat UTF-8 byte buffer plus an int64 offsets array (both .npy, so they can be memory-mapped), and
+numeric columns stored as plain .npy arrays. Nothing is decoded until a value is accessed.
+"""
+import json
+import os
+import shutil
+import tempfile
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Union
+
+import numpy as np
+
+
+class StringColumn(Sequence):
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+
+def _encode_strings(values: List[str]):
+    encoded = [str(value).encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def write_table(directory: Union[str, Path], columns: Dict[str, Union[List, np.ndarray]]):
+    """
+    Write a table of equal-length columns. Columns of str are stored as string columns, anything else
+    as a numpy array. The table is written to a temporary directory and moved into place atomically.
+    """
+    directory = Path(directory)
+    num_rows = {len(values) for values in columns.values()}
+    assert len(num_rows) <= 1, "all columns must have the same length"
+
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=directory.parent, prefix=f".{directory.name}."))
+    schema = {}
+    for name, values in columns.items():
+        if isinstance(values, np.ndarray) and values.dtype != object:
+            np.save(tmp_dir / f"{name}.npy", values)
+            schema[name] = "array"
+        else:
+            data, offsets = _encode_strings(values)
+            np.save(tmp_dir / f"{name}.data.npy", data)
+            np.save(tmp_dir / f"{name}.offsets.npy", offsets)
+            schema[name] = "string"
+    with open(tmp_dir / "meta.json", "w") as fh:
+        json.dump({"num_rows": num_rows.pop() if num_rows else 0, "columns": schema}, fh)
+
+    if directory.exists():
+        shutil.rmtree(directory)
+    os.replace(tmp_dir, directory)
+
+
+def is_table(directory: Union[str, Path]) -> bool:
+    return (Path(directory) / "meta.json").exists()
+
+
+def read_table(directory: Union[str, Path], mmap: bool = True) -> Dict[str, Union[StringColumn, np.ndarray]]:
+    """
+    Open a table written by write_table. Arrays are memory-mapped unless mmap=False.
+    """
+    directory = Path(directory)
+    mmap_mode = "r" if mmap else None
+    with open(directory / "meta.json") as fh:
+        meta = json.load(fh)
+    columns = {}
+    for name, kind in meta["columns"].items():
+        if kind == "string":
+            columns[name] = StringColumn(
+                np.load(directory / f"{name}.data.npy", mmap_mode=mmap_mode),
+                np.load(directory / f"{name}.offsets.npy", mmap_mode=mmap_mode),
+            )
+        else:
+            columns[name] = np.load(directory / f"{name}.npy", mmap_mode=mmap_mode)
+    return columns
@@ -1,7 +1,12 @@
+import functools
+import json
 import os
-from collections import defaultdict
+import re
+import threading
+import unicodedata
 from multiprocessing.pool import ThreadPool
-from typing import Any, Union
+from pathlib import Path
+from typing import Any, Iterable, Iterator, TextIO, Union
 
 import jinja2
 import numpy as np
@@ -21,18 +26,26 @@ HTML_JINJA = """
 <p>Correct Answer: {{ correct_answer }}</p>
 <p>Extracted Answer: {{ extracted_answer }}</p>
 <p>Score: {{ score }}</p>
+{% if cost is defined and cost %}
+<p>Cost: {% for name, value in cost.items() %}{{ name }}={{ value | round(4) if value is float else value }} {% endfor %}</p>
+{% endif %}
 """
 
 
-def _compute_stat(values: list, stat: str):
+def _compute_stat(values: np.ndarray, stat: str):
+    """
+    Compute `stat` over the rows of `values`, per column; missing values are NaN.
+    """
     if stat == "mean":
-        return np.mean(values)
+        return np.nanmean(values, axis=0)
     elif stat == "std":
-        return np.std(values)
+        return np.nanstd(values, axis=0)
     elif stat == "min":
-        return np.min(values)
+        return np.nanmin(values, axis=0)
     elif stat == "max":
-        return np.max(values)
+        return np.nanmax(values, axis=0)
+    elif stat.startswith("p") and stat[1:].isdigit():
+        return np.nanpercentile(values, float(stat[1:]), axis=0)
     else:
         raise ValueError(f"Unknown {stat=}")
 
@@ -44,29 +57,66 @@ def aggregate_results(
 ) -> EvalResult:
     """
     Aggregate results from multiple evaluations into a single EvalResult.
+    Metrics are gathered into one (num_results, num_metrics) array and each stat is computed
+    for all metrics at once.
     """
     name2stats = name2stats or {}
-    name2values = defaultdict(list)
+    name2column = {}
+    rows = []
     htmls = []
     convos = []
     for single_eval_result in single_eval_results:
-        for name, value in single_eval_result.metrics.items():
-            name2values[name].append(value)
+        row = dict(single_eval_result.metrics)
         if single_eval_result.score is not None:
-            name2values["score"].append(single_eval_result.score)
-        htmls.append(single_eval_result.html)
-        convos.append(single_eval_result.convo)
+            row["score"] = single_eval_result.score
+        for name in row:
+            name2column.setdefault(name, len(name2column))
+        rows.append(row)
+        # Evals that keep their examples elsewhere (e.g. a results table) leave these unset
+        if single_eval_result.html is not None:
+            htmls.append(single_eval_result.html)
+        if single_eval_result.convo is not None:
+            convos.append(single_eval_result.convo)
+
+    values = np.full((len(rows), len(name2column)), np.nan)
+    for i, row in enumerate(rows):
+        for name, value in row.items():
+            values[i, name2column[name]] = value
+
+    stats = {stat for name in name2column for stat in name2stats.get(name, default_stats)}
+    stat2values = {stat: _compute_stat(values, stat) for stat in stats}
     final_metrics = {}
-    for name, values in name2values.items():
-        stats = name2stats.get(name, default_stats)
-        for stat in stats:
+    for name, column in name2column.items():
+        for stat in name2stats.get(name, default_stats):
             key = name if stat == "mean" else f"{name}:{stat}"
-            final_metrics[key] = _compute_stat(values, stat)
+            final_metrics[key] = float(stat2values[stat][column])
     return EvalResult(
         score=final_metrics.pop("score", None), metrics=final_metrics, htmls=htmls, convos=convos
     )
 
 
+def bootstrap_means(values: np.ndarray, n_resamples: int = 1000, seed: int = 0, chunk_size: int = 250) -> np.ndarray:
+    """
+    Column means of `n_resamples` bootstrap resamples of the rows of `values` (shape (n,) or (n, k)).
+    Each chunk of resamples is drawn as a matrix of per-row counts and reduced with one matrix product.
+    """
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    rng = np.random.default_rng(seed)
+    means = []
+    for start in range(0, n_resamples, chunk_size):
+        counts = rng.multinomial(n, np.full(n, 1 / n), size=min(chunk_size, n_resamples - start))
+        means.append(counts @ values / n)
+    return np.concatenate(means)
+
+
+def normalize_answer(text: str) -> str:
+    """
+    Canonical form of a free-text answer for comparisons: NFKC, lowercase, collapsed whitespace.
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", str(text)).lower()).strip()
+
+
 def map_with_progress(f: callable, xs: list[Any], num_threads: int = 50):
     """
     Apply f to each element of xs, using a ThreadPool, and show progress.
@@ -78,6 +128,94 @@ def map_with_progress(f: callable, xs: list[Any], num_threads: int = 50):
             return list(tqdm(pool.imap(f, xs), total=len(xs)))
 
 
+class JSONLWriter:
+    """
+    Append-only JSONL writer. Every record is flushed as soon as it is written and the file is
+    fsync'ed every `fsync_every` records, so a crash loses at most the records since the last sync.
+    Safe to share between threads.
+    """
+
+    def __init__(self, path: Union[str, Path], fsync_every: int = 50):
+        path = Path(path)
+        if path.exists():
+            _drop_partial_last_line(path)
+        self.fh = open(path, "a", encoding="utf-8")
+        self.fsync_every = fsync_every
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def write(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.fh.write(line)
+            self.fh.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                os.fsync(self.fh.fileno())
+                self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if self.fh.closed:
+                return
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _drop_partial_last_line(path: Path):
+    """
+    Truncate a trailing record left incomplete by a crash, so appended records start on a fresh line.
+    """
+    with open(path, "rb+") as fh:
+        fh.seek(0, os.SEEK_END)
+        end = fh.tell()
+        if end == 0:
+            return
+        fh.seek(end - 1)
+        if fh.read(1) == b"\n":
+            return
+        pos = end - 1
+        while pos > 0:
+            fh.seek(pos - 1)
+            if fh.read(1) == b"\n":
+                break
+            pos -= 1
+        fh.truncate(pos)
+
+
+def read_jsonl(path: Union[str, Path]) -> Iterator[dict]:
+    """
+    Stream records from a JSONL file, skipping a truncated trailing line.
+    """
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def load_records(path: Union[str, Path]) -> Iterator[dict]:
+    """
+    Stream records from a JSONL file, or from a legacy JSON list written by older versions.
+    """
+    if Path(path).suffix == ".json":
+        with open(path, encoding="utf-8") as fh:
+            yield from json.load(fh)
+    else:
+        yield from read_jsonl(path)
+
+
 jinja_env = jinja2.Environment(
     loader=jinja2.BaseLoader(),
     undefined=jinja2.StrictUndefined,
@@ -96,11 +234,19 @@ _message_template = """
 """
 
 
+@functools.lru_cache(maxsize=None)
+def get_template(source: str) -> jinja2.Template:
+    """
+    Compile a template once and reuse it; compiled templates are safe to render from many threads.
+    """
+    return jinja_env.from_string(source)
+
+
 def message_to_html(message: Message) -> str:
     """
     Generate HTML snippet (inside a <div>) for a message.
     """
-    return jinja_env.from_string(_message_template).render(
+    return get_template(_message_template).render(
         role=message["role"], content=message["content"], variant=message.get("variant", None)
     )
 
@@ -145,6 +291,9 @@ _report_template = """<!DOCTYPE html>
         </style>
     </head>
     <body>
+    {% if nav is defined and nav %}
+    <p>{% for link in nav %}<a href="{{ link.href }}">{{ link.title }}</a> {% endfor %}</p>
+    {% endif %}
     {% if metrics %}
     <h1>Metrics</h1>
     <table>
@@ -164,11 +313,21 @@ _report_template = """<!DOCTYPE html>
     {% endfor %}
     </table>
     {% endif %}
+    {% if pages is defined and pages %}
+    <h1>Pages</h1>
+    <ul>
+    {% for link in pages %}
+    <li><a href="{{ link.href }}">{{ link.title }}</a></li>
+    {% endfor %}
+    </ul>
+    {% endif %}
+    {% if htmls %}
     <h1>Examples</h1>
     {% for html in htmls %}
     {{ html | safe }}
     <hr>
     {% endfor %}
+    {% endif %}
     </body>
 </html>
 """
@@ -178,7 +337,7 @@ def make_report(eval_result: EvalResult) -> str:
     """
     Create a standalone HTML report from an EvalResult.
     """
-    return jinja_env.from_string(_report_template).render(
+    return get_template(_report_template).render(
         score=eval_result.score,
         metrics=eval_result.metrics,
         htmls=eval_result.htmls,
@@ -189,4 +348,127 @@ def make_report_from_example_htmls(htmls: list[str]):
     """
     Create a standalone HTML report from a list of example htmls
     """
-    return jinja_env.from_string(_report_template).render(score=None, metrics={}, htmls=htmls)
+    return get_template(_report_template).render(score=None, metrics={}, htmls=htmls)
+
+
+_leaderboard_template = """<!DOCTYPE html>
+<html>
+    <head>
+        <style>
+            table, th, td {
+                border: 1px solid black;
+                border-collapse: collapse;
+                padding: 4px 8px;
+            }
+            .ci {
+                color: #795548;
+            }
+        </style>
+    </head>
+    <body>
+    <h1>Leaderboard</h1>
+    <p>Graded by {{ grader }}, sorted by {{ sort_by }}.</p>
+    <table>
+    <tr>
+        <th>Rank</th>
+        <th>Model</th>
+        {% for column in columns %}
+        <th>{{ column }}</th>
+        {% endfor %}
+    </tr>
+    {% for row in rows %}
+    <tr>
+        <td>{{ loop.index }}</td>
+        <td>{% if row.report %}<a href="{{ row.report }}">{{ row.model }}</a>{% else %}{{ row.model }}{% endif %}</td>
+        {% for column in columns %}
+        <td>
+        {% if column in row.metrics %}{{ "%.3f" | format(row.metrics[column]) }}{% endif %}
+        {% if (column ~ ":ci_low") in row.metrics %}
+        <span class="ci">[{{ "%.3f" | format(row.metrics[column ~ ":ci_low"]) }}, {{ "%.3f" | format(row.metrics[column ~ ":ci_high"]) }}]</span>
+        {% endif %}
+        </td>
+        {% endfor %}
+    </tr>
+    {% endfor %}
+    </table>
+    </body>
+</html>
+"""
+
+
+def make_leaderboard(rows: list[dict], columns: list[str], grader: str, sort_by: str) -> str:
+    """
+    Create an HTML leaderboard from rows of {"model", "report" (link or None), "metrics"}, already
+    ranked, showing `columns` of the metrics with their confidence intervals where available.
+    """
+    return get_template(_leaderboard_template).render(rows=rows, columns=columns, grader=grader, sort_by=sort_by)
+
+
+def write_report(
+    fh: TextIO,
+    score: Union[float, None] = None,
+    metrics: Union[dict, None] = None,
+    htmls: Iterable[str] = (),
+    **context
+):
+    """
+    Render the HTML report straight to a file handle, chunk by chunk. `htmls` may be any iterable
+    (e.g. a generator), so the examples never need to be held in memory at once.
+    """
+    for chunk in get_template(_report_template).generate(score=score, metrics=metrics or {}, htmls=htmls, **context):
+        fh.write(chunk)
+
+
+def write_paginated_report(
+    report_dir: Union[str, Path],
+    score: Union[float, None],
+    metrics: dict,
+    htmls: Iterable[str],
+    page_size: int = 100
+) -> Path:
+    """
+    Write an index page with the metrics and links to pages of `page_size` examples each.
+    Returns the path of the index page.
+    """
+    report_dir = Path(report_dir)
+    report_dir.mkdir(parents=True, exist_ok=True)
+
+    def page_name(i: int) -> str:
+        return f"page_{i + 1:04d}.html"
+
+    def split_pages(htmls: Iterable[str]) -> Iterator[list[str]]:
+        page = []
+        for html in htmls:
+            page.append(html)
+            if len(page) == page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    # Look one page ahead so each page knows whether to link to a next one
+    page_sizes = []
+    pages = split_pages(htmls)
+    page = next(pages, None)
+    while page is not None:
+        i = len(page_sizes)
+        next_page = next(pages, None)
+        nav = [dict(href="index.html", title="Index")]
+        if i > 0:
+            nav.append(dict(href=page_name(i - 1), title="Previous"))
+        if next_page is not None:
+            nav.append(dict(href=page_name(i + 1), title="Next"))
+        with open(report_dir / page_name(i), "w") as fh:
+            write_report(fh, htmls=page, nav=nav)
+        page_sizes.append(len(page))
+        page = next_page
+
+    links = []
+    start = 1
+    for i, size in enumerate(page_sizes):
+        links.append(dict(href=page_name(i), title=f"Examples {start}-{start + size - 1}"))
+        start += size
+    index_file = report_dir / "index.html"
+    with open(index_file, "w") as fh:
+        write_report(fh, score=score, metrics=metrics, pages=links)
+    return index_file
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Union
+
+from common import normalize_answer
+
+
+class GradeCache:
+    """
+    Persistent cache of grades, keyed by a hash of everything that determines a grade: the grader
+    model, the grader template version, the grading mode, the question, the gold target and the
+    normalized predicted answer. Least recently used entries are evicted beyond `max_entries`.
+    Safe to share between threads and between processes.
+    """
+
+    def __init__(self, path: Union[str, Path], max_entries: int = 1_000_000, evict_every: int = 1000):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS grades (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS grades_last_used ON grades (last_used)")
+        self.conn.commit()
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(
+        grader_model_id: str,
+        template_version: str,
+        grading_mode: str,
+        question: str,
+        target: str,
+        predicted_answer: str
+    ) -> str:
+        fields = [grader_model_id, template_version, grading_mode, question, target, normalize_answer(predicted_answer)]
+        return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Union[Dict, None]:
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM grades WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE grades SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key: str, value: Dict):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO grades (key, value, last_used) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time())
+            )
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM grades").fetchone()
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM grades WHERE key IN (SELECT key FROM grades ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "grade_cache_hits": self.hits,
+            "grade_cache_misses": self.misses,
+            "grade_cache_hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self.conn.commit()
+            self.conn.close()
@@ -1,8 +1,110 @@
-from typing import Any, Dict, Union
-from classes import MessageList, SamplerBase
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple, Union
+from classes import MessageList, SamplerBase, SamplerResponse
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache, StoppingCriteria, StoppingCriteriaList
 import torch
+import copy
+import gc
 import os
+import time
+
+# Stop before the model starts writing the next turn of the chat
+DEFAULT_STOP = ["\nUser:"]
+
+DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16, "float16": torch.float16}
+QUANTIZATION_MODES = ["int8"]
+
+
+def bf16_supported(device: Union[str, None]) -> bool:
+    """
+    Whether `device` computes in bfloat16 natively (CUDA with bf16 support, or a CPU with AVX512-BF16/AMX).
+    """
+    if device and device.startswith("cuda"):
+        return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    if device is None and torch.cuda.is_available():
+        return torch.cuda.is_bf16_supported()
+    return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+
+
+def set_cpu_threads(num_threads: Union[int, None] = None, num_interop_threads: Union[int, None] = None):
+    """
+    Size torch's intra-op and inter-op CPU thread pools. The inter-op pool can only be sized before
+    its first use, so a later request is reported and ignored.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads and num_interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            print(f"Inter-op thread pool already started; keeping {torch.get_num_interop_threads()} threads")
+
+
+class StopOnStrings(StoppingCriteria):
+    """
+    Marks each row of a batch as finished once its generated text contains one of the stop strings.
+    """
+
+    def __init__(self, tokenizer, stop: List[str], prompt_length: int):
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.prompt_length = prompt_length
+        # A token decodes to at least one character, so this many tokens always cover a stop string
+        self.lookback = max(len(s) for s in stop) + 1
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        start = max(self.prompt_length, input_ids.shape[1] - self.lookback)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+        return torch.tensor([any(s in tail for s in self.stop) for tail in tails], device=input_ids.device)
+
+
+class FinishSteps(StoppingCriteria):
+    """
+    Stops rows as `criteria` do, and records how many tokens each row generated until it finished: on
+    a stop token (counted) or by a criterion. Whatever a finished row holds after that is padding.
+    """
+
+    def __init__(self, stop_token_ids: List[int], prompt_length: int, batch_size: int, criteria: List = ()):
+        self.stop_token_ids = stop_token_ids
+        self.prompt_length = prompt_length
+        self.criteria = criteria
+        self.steps = [None] * batch_size
+        self._seen = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for criterion in self.criteria:
+            done |= criterion(input_ids, scores, **kwargs)
+        # Assisted generation can add several tokens per step
+        added = input_ids[:, self._seen:]
+        stopped = torch.isin(added, torch.tensor(self.stop_token_ids, device=added.device))
+        for i, step in enumerate(self.steps):
+            if step is not None:
+                continue
+            if stopped[i].any():
+                self.steps[i] = self._seen - self.prompt_length + int(stopped[i].int().argmax()) + 1
+            elif done[i]:
+                self.steps[i] = input_ids.shape[1] - self.prompt_length
+        self._seen = input_ids.shape[1]
+        return done
+
+    def completion_tokens(self, num_new_tokens: int) -> List[int]:
+        # Rows that never finished ran to the end of the batch
+        return [num_new_tokens if step is None else step for step in self.steps]
+
+
+class FirstTokenTimer(StoppingCriteria):
+    """
+    Never stops generation; records when the first token is out, which ends the prefill.
+    """
+
+    def __init__(self):
+        self.first_token_time = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
 
 
 class HFChatCompletionSampler(SamplerBase):
@@ -14,17 +116,102 @@ class HFChatCompletionSampler(SamplerBase):
         system_message: Union[str, None] = None,
         max_tokens: int = 1024,
         temperature: float = 0.7,
-        device: str = "cuda" if torch.cuda.is_available() else "cpu"
+        device: Union[str, None] = None,
+        batch_size: int = 1,
+        sort_by_length: bool = True,
+        stop: Union[List[str], None] = None,
+        stop_token_ids: Union[List[int], None] = None,
+        profile_dir: Union[str, Path, None] = None,
+        profile_every: int = 100,
+        dtype: Union[str, None] = None,
+        quantize: Union[str, None] = None,
+        num_threads: Union[int, None] = None,
+        num_interop_threads: Union[int, None] = None,
+        low_cpu_mem_usage: bool = False,
+        draft_model: Union[str, None] = None
     ):
+        self.model_name = model_dir or model
+        # Local checkpoints are identified by their real path, whatever path they were loaded from
+        self._checkpoint = os.path.realpath(model_dir) if model_dir else model
+        self.dtype = dtype
+        self.quantize = quantize
+        # Without a device the model is spread over all available resources
+        device_map = device or "auto"
+        set_cpu_threads(num_threads, num_interop_threads)
+        load_kwargs = {"device_map": device_map}
+        # quantize_dynamic only converts float32 linear layers; reduced-precision ones fail at the first forward
+        assert not (quantize and dtype not in (None, "float32")), \
+            f"{quantize=} needs float32 weights; drop {dtype=} or pass dtype='float32'"
+        if dtype:
+            assert dtype in DTYPES, f"Unknown {dtype=}, expected one of {list(DTYPES)}"
+            if dtype == "bfloat16" and not bf16_supported(device):
+                print("Warning: no native bfloat16 support on this device; bfloat16 matmuls will be emulated")
+            load_kwargs["dtype"] = DTYPES[dtype]
+        elif quantize:
+            # Checkpoints stored in reduced precision are upcast so their linear layers can be quantized
+            load_kwargs["dtype"] = torch.float32
+        if low_cpu_mem_usage:
+            # Weights are memory-mapped from the safetensors files instead of being materialized twice
+            load_kwargs.update(low_cpu_mem_usage=True, use_safetensors=True)
         if model_dir:
             self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
-            self.model = AutoModelForCausalLM.from_pretrained(model_dir, device_map="auto")
+            self.model = AutoModelForCausalLM.from_pretrained(model_dir, **load_kwargs)
         else:
             self.tokenizer = AutoTokenizer.from_pretrained(model)
-            self.model = AutoModelForCausalLM.from_pretrained(model, device_map="auto")
+            self.model = AutoModelForCausalLM.from_pretrained(model, **load_kwargs)
+        # A small model sharing the tokenizer proposes tokens that the model verifies (speculative sampling)
+        self.draft = AutoModelForCausalLM.from_pretrained(draft_model, **load_kwargs) if draft_model else None
+        if quantize:
+            assert quantize in QUANTIZATION_MODES, f"Unknown {quantize=}, expected one of {QUANTIZATION_MODES}"
+            assert self.model.device.type == "cpu", "int8 dynamic quantization runs on CPU only; pass device='cpu'"
+            # Weights of every linear layer are stored in int8; activations are quantized on the fly
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            if self.draft is not None:
+                self.draft = torch.ao.quantization.quantize_dynamic(self.draft, {torch.nn.Linear}, dtype=torch.qint8)
+        # Left padding keeps the last prompt token of every row aligned for generation
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.configure(
+            system_message, max_tokens, temperature, batch_size, sort_by_length, stop, stop_token_ids,
+            profile_dir, profile_every
+        )
+
+    def configure(
+        self,
+        system_message: Union[str, None] = None,
+        max_tokens: int = 1024,
+        temperature: float = 0.7,
+        batch_size: int = 1,
+        sort_by_length: bool = True,
+        stop: Union[List[str], None] = None,
+        stop_token_ids: Union[List[int], None] = None,
+        profile_dir: Union[str, Path, None] = None,
+        profile_every: int = 100
+    ) -> None:
+        """
+        Set the generation settings and drop the cached prefix. A shallow copy of a loaded sampler,
+        reconfigured, shares its model with the original.
+        """
         self.system_message = system_message
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.batch_size = max(1, batch_size)
+        self.sort_by_length = sort_by_length
+        self.stop = DEFAULT_STOP if stop is None else stop
+        self.stop_token_ids = [self.tokenizer.eos_token_id] + (stop_token_ids or [])
+        self._prefix = None
+        self._prefix_ids = None
+        self._prefix_cache = None
+        # Every `profile_every`-th generate call is traced with torch.profiler into `profile_dir`
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.profile_every = max(1, profile_every)
+        self._num_generate_calls = 0
+
+    def cache_identity(self) -> Dict[str, Any]:
+        return {
+            "model": self._checkpoint, "dtype": self.dtype, "quantize": self.quantize, "temperature": self.temperature
+        }
 
     def _pack_message(self, role: str, content: Any) -> Dict:
         return {"role": str(role), "content": str(content)}
@@ -41,26 +228,242 @@ class HFChatCompletionSampler(SamplerBase):
 
         return prompt
 
-    def __call__(self, message_list: MessageList) -> str:
-        # Format messages into prompt
+    def _build_prompt(self, message_list: MessageList) -> str:
         if self.system_message:
             message_list = [self._pack_message("system", self.system_message)] + message_list
+        return self._pack_message_to_string(message_list)
 
-        prompt = self._pack_message_to_string(message_list)
+    def _truncate_at_stop(self, response: str) -> str:
+        for s in self.stop:
+            response = response.split(s)[0]
+        return response.strip()
 
-        # Generate response
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
-        outputs = self.model.generate(
-            **inputs,
-            do_sample=True,
-            max_new_tokens=self.max_tokens,
-            temperature=self.temperature,
-            pad_token_id=self.tokenizer.eos_token_id
-        )
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+    @torch.no_grad()
+    def cache_prefix(self, prefix: str) -> None:
+        packed = self._build_prompt([self._pack_message("user", prefix)])
+        self._prefix = packed[:packed.rindex(prefix) + len(prefix)]
+        self._prefix_ids = self.tokenizer(self._prefix, return_tensors="pt")["input_ids"].to(self.model.device)
+        self._prefix_cache = self.model(
+            input_ids=self._prefix_ids, past_key_values=DynamicCache(), use_cache=True
+        ).past_key_values
+
+    def _uses_prefix(self, prompt: str) -> bool:
+        return self._prefix is not None and prompt.startswith(self._prefix) and len(prompt) > len(self._prefix)
 
-        # Extract assistant response
+    @torch.no_grad()
+    def _encode_shared(
+        self, prompts: List[str], unique: List[str]
+    ) -> Tuple[torch.Tensor, torch.Tensor, DynamicCache]:
+        # The distinct prompts are prefilled once, up to their last token, and the cache rows are
+        # copied for every repeat of a prompt; generation then starts from the last token
+        inputs = self.tokenizer(unique, return_tensors="pt", padding=True).to(self.model.device)
+        input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        cache = self.model(
+            input_ids=input_ids[:, :-1],
+            attention_mask=attention_mask[:, :-1],
+            position_ids=position_ids[:, :-1],
+            past_key_values=DynamicCache(),
+            use_cache=True
+        ).past_key_values
+        row_of = {prompt: i for i, prompt in enumerate(unique)}
+        rows = torch.tensor([row_of[prompt] for prompt in prompts], device=input_ids.device)
+        cache.batch_select_indices(rows)
+        return input_ids[rows], attention_mask[rows], cache
+
+    def _encode(self, prompts: List[str]) -> Tuple[torch.Tensor, torch.Tensor, Union[DynamicCache, None]]:
+        if not self._uses_prefix(prompts[0]):
+            unique = list(dict.fromkeys(prompts))
+            if len(unique) < len(prompts):
+                return self._encode_shared(prompts, unique)
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+            return inputs["input_ids"], inputs["attention_mask"], None
+
+        # Pad between the cached prefix and each suffix so the prefix occupies the same positions in every row
+        suffixes = self.tokenizer(
+            [prompt[len(self._prefix):] for prompt in prompts],
+            return_tensors="pt", padding=True, add_special_tokens=False
+        ).to(self.model.device)
+        prefix_ids = self._prefix_ids.expand(len(prompts), -1)
+        input_ids = torch.cat([prefix_ids, suffixes["input_ids"]], dim=-1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids), suffixes["attention_mask"]], dim=-1)
+        cache = copy.deepcopy(self._prefix_cache)
+        if len(prompts) > 1:
+            cache.batch_repeat_interleave(len(prompts))
+        return input_ids, attention_mask, cache
+
+    def _profiled(self, fn, *args):
+        self._num_generate_calls += 1
+        if self.profile_dir is None or (self._num_generate_calls - 1) % self.profile_every:
+            return fn(*args)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, record_shapes=True) as profiler:
+            result = fn(*args)
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        profiler.export_chrome_trace(str(self.profile_dir / f"generate_{self._num_generate_calls - 1:06d}.json"))
+        return result
+
+    def _generate(self, prompts: List[str]) -> List[SamplerResponse]:
+        start = time.perf_counter()
+        input_ids, attention_mask, cache = self._encode(prompts)
+        timer = FirstTokenTimer()
+        finish = FinishSteps(
+            self.stop_token_ids, input_ids.shape[1], input_ids.shape[0],
+            [StopOnStrings(self.tokenizer, self.stop, input_ids.shape[1])] if self.stop else []
+        )
+        # Forward passes of each model, to measure how many drafted tokens were accepted
+        forwards = {"target": 0, "draft": 0}
+        hooks = []
+        if self.draft is not None:
+            for name, module in (("target", self.model), ("draft", self.draft)):
+                def count(*_, name=name):
+                    forwards[name] += 1
+                hooks.append(module.register_forward_hook(count))
         try:
-            return response.split("Assistant: ")[-1].strip()
-        except Exception:
-            return response
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=cache,
+                assistant_model=self.draft,
+                do_sample=True,
+                max_new_tokens=self.max_tokens,
+                temperature=self.temperature,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.stop_token_ids,
+                stopping_criteria=StoppingCriteriaList([timer, finish])
+            )
+        finally:
+            for hook in hooks:
+                hook.remove()
+        end = time.perf_counter()
+        first_token_time = timer.first_token_time or end
+
+        # Decode only the newly generated tokens
+        new_tokens = outputs[:, input_ids.shape[1]:]
+        responses = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        completion_tokens = finish.completion_tokens(new_tokens.shape[1])
+        prompt_tokens = attention_mask.sum(dim=-1).tolist()
+        draft_stats = {}
+        if self.draft is not None:
+            # Each verification pass keeps the accepted drafted tokens plus one token of its own;
+            # every draft forward pass proposes one token (batches hold a single prompt)
+            draft_stats = {
+                "draft_tokens": forwards["draft"],
+                "draft_accepted_tokens": max(0, new_tokens.shape[1] - forwards["target"]),
+                "target_forwards": forwards["target"],
+            }
+        # Times are those of the whole batch, shared by its rows
+        return [
+            SamplerResponse(
+                response_text=self._truncate_at_stop(response),
+                response_metadata={
+                    "prompt_tokens": prompt_tokens[i],
+                    "completion_tokens": completion_tokens[i],
+                    "prefill_time": first_token_time - start,
+                    "decode_time": end - first_token_time,
+                    "latency": end - start,
+                    "batch_size": len(prompts),
+                } | draft_stats
+            )
+            for i, response in enumerate(responses)
+        ]
+
+    def _batches(self, prompts: List[str], generation: bool = False) -> Iterator[List[int]]:
+        # Assisted generation handles one sequence at a time. Otherwise the copies of a prompt
+        # (repeated samples) always share a batch, which holds up to `batch_size` distinct prompts
+        assisted = generation and self.draft is not None
+        batch_size = 1 if assisted else self.batch_size
+        order = list(range(len(prompts)))
+        if self.sort_by_length and batch_size > 1 and prompts:
+            # Group prompts of similar length so each batch carries little padding
+            lengths = [len(ids) for ids in self.tokenizer(prompts)["input_ids"]]
+            order.sort(key=lambda i: lengths[i], reverse=True)
+
+        # Prompts that reuse the cached prefix are never batched with prompts that do not
+        uses_prefix = [self._uses_prefix(prompt) for prompt in prompts]
+        for group in (True, False):
+            units = {}
+            for i in order:
+                if uses_prefix[i] == group:
+                    units.setdefault(i if assisted else prompts[i], []).append(i)
+            units = list(units.values())
+            for start in range(0, len(units), batch_size):
+                yield [i for unit in units[start:start + batch_size] for i in unit]
+
+    def imap_batch(self, message_lists: List[MessageList]) -> Iterator[Tuple[int, SamplerResponse]]:
+        prompts = [self._build_prompt(message_list) for message_list in message_lists]
+        for batch in self._batches(prompts, generation=True):
+            responses = self._profiled(self._generate, [prompts[i] for i in batch])
+            yield from zip(batch, responses)
+
+    def _choice_token_ids(self, choice: str) -> List[int]:
+        # The choice may follow the prompt with or without a leading space depending on the tokenizer
+        token_ids = set()
+        for variant in (choice, " " + choice):
+            ids = self.tokenizer.encode(variant, add_special_tokens=False)
+            ids = [i for i in ids if self.tokenizer.decode([i]).strip()]
+            if ids:
+                token_ids.add(ids[0])
+        return sorted(token_ids)
+
+    @torch.no_grad()
+    def _score_choices(self, prompts: List[str], choices: List[str]) -> List[Tuple[List[float], Dict]]:
+        start = time.perf_counter()
+        input_ids, attention_mask, cache = self._encode(prompts)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        # Only feed the tokens that are not already in the prefix cache
+        cached = cache.get_seq_length() if cache is not None else 0
+        logits = self.model(
+            input_ids=input_ids[:, cached:],
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, cached:],
+            past_key_values=cache,
+        ).logits[:, -1, :].float()
+        log_probs = torch.log_softmax(logits, dim=-1)
+        choice_log_probs = torch.stack(
+            [torch.logsumexp(log_probs[:, self._choice_token_ids(choice)], dim=-1) for choice in choices],
+            dim=-1
+        )
+        probs = torch.softmax(choice_log_probs, dim=-1).tolist()
+        latency = time.perf_counter() - start
+        # The single forward pass is all prefill; its time is that of the whole batch, as in _generate
+        prompt_tokens = attention_mask.sum(dim=-1).tolist()
+        return [
+            (probs[i], {
+                "prompt_tokens": prompt_tokens[i],
+                "prefill_time": latency,
+                "latency": latency,
+                "batch_size": len(prompts),
+            })
+            for i in range(len(prompts))
+        ]
+
+    def score_choices_batch_with_metadata(
+        self, message_lists: List[MessageList], choices: List[str]
+    ) -> List[Tuple[List[float], Dict]]:
+        prompts = [self._build_prompt(message_list) for message_list in message_lists]
+        scores = [None] * len(prompts)
+        for batch in self._batches(prompts):
+            for i, scored in zip(batch, self._score_choices([prompts[i] for i in batch], choices)):
+                scores[i] = scored
+        return scores
+
+    def score_choices_batch(self, message_lists: List[MessageList], choices: List[str]) -> List[List[float]]:
+        return [probs for probs, _ in self.score_choices_batch_with_metadata(message_lists, choices)]
+
+    def score_choices(self, message_list: MessageList, choices: List[str]) -> List[float]:
+        return self.score_choices_batch([message_list], choices)[0]
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        return self.sample_batch([message_list])[0]
+
+    def unload(self) -> None:
+        self.model = None
+        self.draft = None
+        self._prefix_cache = None
+        self._prefix_ids = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -0,0 +1,198 @@
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import as_completed
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+import httpx
+import numpy as np
+
+from classes import MessageList, SamplerBase, SamplerResponse
+
+# Retried with backoff; any other error status fails the request immediately
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class HTTPChatCompletionSampler(SamplerBase):
+    """
+    Sampler for a model served behind an OpenAI-compatible chat completions endpoint (vLLM, TGI, ...).
+    All calls, from any number of threads, go through one pooled keep-alive client on a background
+    event loop, with at most `max_concurrency` requests in flight. Failed requests are retried with
+    exponential backoff and the latency of every request is recorded.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        api_base: str,
+        api_key: Union[str, None] = os.environ.get("OPENAI_API_KEY", None),
+        system_message: Union[str, None] = None,
+        max_tokens: int = 1024,
+        temperature: float = 0.7,
+        max_concurrency: int = 32,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        timeout: float = 120.0,
+        stop: Union[List[str], None] = None
+    ):
+        self.model_name = model
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.system_message = system_message
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stop = stop
+        self.latencies = []
+        self.retries = 0
+        self._lock = threading.Lock()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        self._client, self._semaphore = self._run(self._open(headers, limits, timeout)).result()
+
+    def cache_identity(self) -> Dict[str, Any]:
+        return {"model": self.model_name, "url": self.url, "temperature": self.temperature}
+
+    async def _open(self, headers: Dict, limits: httpx.Limits, timeout: float):
+        # Both are bound to the background loop, so they are created on it
+        return httpx.AsyncClient(headers=headers, limits=limits, timeout=timeout), asyncio.Semaphore(self.max_concurrency)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _pack_message(self, role: str, content: Any) -> Dict:
+        return {"role": str(role), "content": str(content)}
+
+    def _messages(self, message_list: MessageList) -> MessageList:
+        if self.system_message:
+            return [self._pack_message("system", self.system_message)] + message_list
+        return message_list
+
+    async def _post(self, payload: Dict) -> Tuple[Dict, Dict[str, float]]:
+        """
+        POST `payload`, returning the decoded result and the request's queue time and latency.
+        """
+        submitted = time.perf_counter()
+        async with self._semaphore:
+            queue_time = time.perf_counter() - submitted
+            for attempt in range(self.max_retries + 1):
+                start = time.perf_counter()
+                try:
+                    response = await self._client.post(self.url, json=payload)
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        response.raise_for_status()
+                        latency = time.perf_counter() - start
+                        with self._lock:
+                            self.latencies.append(latency)
+                        return response.json(), {"queue_time": queue_time, "latency": latency}
+                    error = httpx.HTTPStatusError(
+                        f"Server returned {response.status_code}", request=response.request, response=response
+                    )
+                except httpx.TransportError as e:
+                    error = e
+                if attempt == self.max_retries:
+                    raise error
+                with self._lock:
+                    self.retries += 1
+                # Exponential backoff with full jitter
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    async def _complete(self, message_list: MessageList) -> SamplerResponse:
+        payload = {
+            "model": self.model_name,
+            "messages": self._messages(message_list),
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+        }
+        if self.stop:
+            payload["stop"] = self.stop
+        result, timing = await self._post(payload)
+        usage = result.get("usage") or {}
+        return SamplerResponse(
+            response_text=(result["choices"][0]["message"]["content"] or "").strip(),
+            response_metadata={
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+            } | timing
+        )
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        return self._run(self._complete(message_list)).result()
+
+    def imap_batch(self, message_lists: List[MessageList]) -> Iterator[Tuple[int, SamplerResponse]]:
+        futures = {self._run(self._complete(message_list)): i for i, message_list in enumerate(message_lists)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    async def _score_choices(self, message_list: MessageList, choices: List[str]) -> Tuple[List[float], Dict]:
+        payload = {
+            "model": self.model_name,
+            "messages": self._messages(message_list),
+            "max_tokens": 1,
+            "temperature": 0.0,
+            "logprobs": True,
+            "top_logprobs": 20,
+        }
+        result, timing = await self._post(payload)
+        metadata = {"prompt_tokens": (result.get("usage") or {}).get("prompt_tokens")} | timing
+        top_logprobs = result["choices"][0]["logprobs"]["content"][0]["top_logprobs"]
+        # Tokens with and without a leading space both count towards a choice
+        choice_log_probs = []
+        for choice in choices:
+            log_probs = [entry["logprob"] for entry in top_logprobs if entry["token"].strip() == choice]
+            choice_log_probs.append(np.logaddexp.reduce(log_probs) if log_probs else -math.inf)
+        choice_log_probs = np.array(choice_log_probs)
+        if np.isneginf(choice_log_probs).all():
+            # None of the choices is among the top tokens
+            return [1 / len(choices)] * len(choices), metadata
+        probs = np.exp(choice_log_probs - choice_log_probs.max())
+        return (probs / probs.sum()).tolist(), metadata
+
+    def score_choices(self, message_list: MessageList, choices: List[str]) -> List[float]:
+        return self._run(self._score_choices(message_list, choices)).result()[0]
+
+    def score_choices_batch_with_metadata(
+        self, message_lists: List[MessageList], choices: List[str]
+    ) -> List[Tuple[List[float], Dict]]:
+        futures = [self._run(self._score_choices(message_list, choices)) for message_list in message_lists]
+        return [future.result() for future in futures]
+
+    def score_choices_batch(self, message_lists: List[MessageList], choices: List[str]) -> List[List[float]]:
+        return [probs for probs, _ in self.score_choices_batch_with_metadata(message_lists, choices)]
+
+    def latency_stats(self) -> Dict[str, float]:
+        """
+        Summary of the recorded per-request latencies, in seconds.
+        """
+        with self._lock:
+            latencies = np.array(self.latencies)
+            retries = self.retries
+        if not len(latencies):
+            return {"requests": 0, "retries": retries}
+        return {
+            "requests": len(latencies),
+            "retries": retries,
+            "latency_mean": float(latencies.mean()),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_max": float(latencies.max()),
+        }
+
+    def close(self):
+        """
+        Close the connection pool and stop the background event loop.
+        """
+        self._run(self._client.aclose()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def unload(self) -> None:
+        self.close()
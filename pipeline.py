@@ -0,0 +1,123 @@
+"""
+Pipelined generation and grading: a producer thread streams finished responses into a bounded
+queue while grading threads grade them as they arrive, so the grader no longer idles through
+generation and the wall-clock time approaches max(generation, grading) rather than their sum.
+"""
+import queue
+import threading
+from pathlib import Path
+from typing import Dict, List, Union
+
+from tqdm import tqdm
+
+import common
+from batching_sampler import BatchingSampler
+from cascade_grader import CascadeGrader
+from classes import SamplerBase
+from grade_cache import GradeCache
+from sharding import pin_cpu_set
+from simpleqa_eval import GRADER_PREFIX, SimpleQAEval, record_key
+
+
+def run_pipelined(
+    model: SamplerBase,
+    grader_model: SamplerBase,
+    num_examples: Union[int, None] = None,
+    n_repeats: int = 1,
+    responses_file: Union[str, Path, None] = None,
+    grades_file: Union[str, Path, None] = None,
+    grading_mode: str = "generate",
+    grade_cache: Union[GradeCache, None] = None,
+    pregrade: bool = False,
+    num_shards: int = 1,
+    shard_id: int = 0,
+    queue_size: int = 64,
+    num_grader_threads: int = 16,
+    grader_batch_size: int = 8,
+    grader_max_wait_ms: float = 10.0,
+    cpu_set: Union[str, None] = None,
+    grader_cpu_set: Union[str, None] = None
+) -> List[Dict]:
+    """
+    Generate responses with `model` and grade them with `grader_model` concurrently. At most
+    `queue_size` responses wait for grading; generation blocks when the queue is full. Responses
+    and grades are streamed to `responses_file`/`grades_file` exactly as in the sequential stages,
+    so an interrupted run resumes either stage. Grading threads share `grader_model` through a
+    BatchingSampler. The two models should live on separate devices (or `cpu_set`/`grader_cpu_set`
+    core lists) to overlap. Returns the response records; the grades are in `grades_file`.
+    """
+    grades = {}
+    if grades_file and Path(grades_file).exists():
+        grades = {record_key(grade): grade for grade in common.read_jsonl(grades_file)}
+    writer = common.JSONLWriter(grades_file) if grades_file else None
+
+    pending = queue.Queue(maxsize=queue_size)
+    errors = []
+    responses = []
+
+    def enqueue(record: Dict):
+        if record_key(record) in grades:
+            return
+        # Wait for room in the queue, but give up once grading has failed
+        while True:
+            if errors:
+                raise RuntimeError("Grading failed; stopping generation") from errors[0]
+            try:
+                pending.put(record, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        pin_cpu_set(cpu_set)
+        try:
+            responses.extend(SimpleQAEval.generate_responses(
+                model, num_examples=num_examples, n_repeats=n_repeats, output_file=responses_file,
+                num_shards=num_shards, shard_id=shard_id, on_response=enqueue
+            ))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for _ in range(num_grader_threads):
+                pending.put(None)
+
+    def consume(pbar: tqdm):
+        while (response := pending.get()) is not None:
+            if errors:
+                continue  # drain the queue so the producer never blocks
+            try:
+                grade = SimpleQAEval.grade(grader, response, grading_mode, grade_cache, pregrade)
+            except Exception as e:
+                errors.append(e)
+                continue
+            if writer:
+                writer.write(grade)
+            grades[record_key(grade)] = grade
+            pbar.update(1)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    # The grader's batching worker, started after pinning, inherits the grader's cores
+    pin_cpu_set(grader_cpu_set)
+    # A cascade batches each of its graders itself
+    batching = not isinstance(grader_model, CascadeGrader)
+    if batching:
+        grader = BatchingSampler(grader_model, max_batch_size=grader_batch_size, max_wait_ms=grader_max_wait_ms)
+    else:
+        grader = grader_model
+    grader.cache_prefix(GRADER_PREFIX)
+    with tqdm(desc="Grading", position=1) as pbar:
+        consumers = [threading.Thread(target=consume, args=(pbar,), daemon=True) for _ in range(num_grader_threads)]
+        for consumer in consumers:
+            consumer.start()
+        producer.join()
+        for consumer in consumers:
+            consumer.join()
+    if batching:
+        grader.close()
+    if writer:
+        writer.close()
+
+    if errors:
+        raise errors[0]
+    return responses
@@ -0,0 +1,153 @@
+"""
+Rule-based grading of the responses whose grade is unambiguous, so only the rest are sent to the
+grader model. Every rule errs on the side of returning None (undecided).
+"""
+import math
+import re
+import string
+from typing import List, Tuple, Union
+
+from common import normalize_answer
+
+
+_ARTICLES = {"a", "an", "the"}
+_PUNCTUATION = re.compile(f"[{re.escape(string.punctuation)}]")
+# Characters that change what an answer says ("-32", "50%", "$5", "3.5") are kept for matching
+_SIGNIFICANT = "-+%$#&@/"
+_INSIGNIFICANT = re.compile(
+    rf"[{re.escape(''.join(c for c in string.punctuation if c not in _SIGNIFICANT + '.,'))}]|(?<!\d)[.,]|[.,](?!\d)"
+)
+# Lead-ins before a bare answer, in match form (articles dropped, apostrophes split: "it's" -> "it s")
+_LEAD_IN = re.compile(r"^(?:(?:correct )?answer (?:is|was)|(?:it|that|this|he|she|they) (?:is|was|were|s))\s+")
+# What may remain of a refusal once its phrase is removed, for it to still be a plain refusal
+FILLER_WORDS = {
+    "i", "m", "am", "sorry", "unfortunately", "answer", "to", "this", "that", "question", "information", "about",
+    "it", "is", "of", "on", "for", "please", "you", "your", "me", "here", "any", "know", "sure", "s",
+    "who", "what", "when", "where", "which", "how", "whether", "with", "certainty", "confidently", "accurately",
+}
+
+REFUSAL_PATTERNS = [
+    r"\bi (?:do not|don't|dont) know\b",
+    r"\bi(?:'m| am) not (?:sure|certain|aware)\b",
+    r"\bi (?:cannot|can't|can not|am unable to|'m unable to|could not|couldn't) (?:answer|provide|determine|find|say|confirm|verify)\b",
+    r"\b(?:i have|there is) no (?:information|data|record)\b",
+    r"\bi(?:'m| am) unable to\b",
+]
+# Words that turn a refusal into a (hedged) guess, which the grader model has to judge
+GUESS_WORDS = {"maybe", "perhaps", "possibly", "probably", "might", "likely", "think", "believe", "guess", "but"}
+# Words that make an answer hedged, conditional or a list of alternatives
+HEDGE_WORDS = GUESS_WORDS | {
+    "or", "either", "not", "no", "never", "unsure", "uncertain", "around", "about", "approximately", "roughly",
+    "nearly", "almost", "over", "under", "more", "less", "least", "most", "between", "than", "unknown",
+}
+# A contained gold answer is only trusted in a response at most this many words longer than it
+MAX_EXTRA_WORDS = 12
+
+_DIGITS = r"([-+]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?|[-+]?\.\d+)"
+# Magnitude suffixes count only as words or letters attached to the number ("120k"), never "5 m"
+_SUFFIX = r"(?:\s*(thousand|million|billion)|(k|m|b))?"
+_GOLD_NUMBER = re.compile(rf"^\s*{_DIGITS}{_SUFFIX}\s*$", re.I)
+_RESPONSE_NUMBER = re.compile(rf"{_DIGITS}{_SUFFIX}\b", re.I)
+_MULTIPLIERS = {"k": 1e3, "thousand": 1e3, "m": 1e6, "million": 1e6, "b": 1e9, "billion": 1e9}
+
+
+def _match_form(text: str) -> str:
+    words = _INSIGNIFICANT.sub(" ", normalize_answer(text)).split()
+    return " ".join(word for word in words if word not in _ARTICLES)
+
+
+def _bare_answer(response: str) -> str:
+    """
+    The response in match form without a lead-in such as "it is" or "the answer is".
+    """
+    return _LEAD_IN.sub("", response)
+
+
+def _only_refusal(predicted_answer: str) -> bool:
+    """
+    Whether nothing but filler remains once the refusal phrases are removed ("I'm not sure. It is
+    London." still names an answer).
+    """
+    text = normalize_answer(predicted_answer)
+    for pattern in REFUSAL_PATTERNS:
+        text = re.sub(pattern, " ", text)
+    return all(word in FILLER_WORDS for word in _match_form(text).split())
+
+
+def _contains_phrase(text: str, phrase: str) -> bool:
+    return bool(phrase) and f" {phrase} " in f" {text} "
+
+
+def _parse_number(digits: str, suffix: Union[str, None]) -> Tuple[float, Union[float, None]]:
+    """
+    Return (value, precision) where precision is the place value of the last significant figure,
+    or None when the trailing zeros of a plain integer make the precision ambiguous (e.g. years).
+    """
+    digits = digits.replace(",", "")
+    multiplier = _MULTIPLIERS[suffix.lower()] if suffix else 1.0
+    value = float(digits) * multiplier
+    if "." in digits:
+        precision = 10 ** -len(digits.split(".")[1]) * multiplier
+    elif suffix:
+        stripped = digits.lstrip("+-").rstrip("0")
+        precision = 10 ** (len(digits.lstrip("+-")) - len(stripped)) * multiplier if stripped else multiplier
+    elif not digits.endswith("0"):
+        precision = 1.0
+    else:
+        precision = None
+    return value, precision
+
+
+def _grade_number(target: str, predicted_answer: str) -> Union[str, None]:
+    gold = _GOLD_NUMBER.match(target)
+    if not gold:
+        return None
+    numbers = _RESPONSE_NUMBER.findall(predicted_answer)
+    if len(numbers) != 1:
+        return None
+    gold_digits, gold_word, gold_letter = gold.groups()
+    gold_value, precision = _parse_number(gold_digits, gold_word or gold_letter)
+    digits, word, letter = numbers[0]
+    value, _ = _parse_number(digits, word or letter)
+    if value == gold_value:
+        return "A"
+    if precision is None:
+        return None
+    # Correct to the last significant figure of the gold target (e.g. 124k and 115k both match 120k)
+    same = math.floor(value / precision + 0.5) == math.floor(gold_value / precision + 0.5)
+    return "A" if same else "B"
+
+
+def pregrade(question: str, target: str, predicted_answer: str) -> Tuple[Union[str, None], str]:
+    """
+    Grade a response without a model when a rule can decide it. Returns the grade letter, or None if
+    the response must go to the grader model, and the name of the rule (or "model") that decides it.
+    """
+    response = _match_form(predicted_answer)
+    gold = _match_form(target)
+    words: List[str] = response.split()
+
+    if not _PUNCTUATION.sub("", normalize_answer(predicted_answer)):
+        return "C", "rule:empty"
+    if response == gold:
+        return "A", "rule:exact"
+
+    hedged = bool(HEDGE_WORDS.intersection(words)) or "?" in predicted_answer
+    if any(re.search(pattern, normalize_answer(predicted_answer)) for pattern in REFUSAL_PATTERNS):
+        guessed = bool(GUESS_WORDS.intersection(words)) or any(c.isdigit() for c in response)
+        if not guessed and not _contains_phrase(response, gold) and _only_refusal(predicted_answer):
+            return "C", "rule:refusal"
+        return None, "model"
+    if hedged or len(words) > len(gold.split()) + MAX_EXTRA_WORDS:
+        return None, "model"
+
+    # Several numbers could each be the answer; a numeric gold target is left to the model when the rule abstains
+    if len(_RESPONSE_NUMBER.findall(predicted_answer)) > 1:
+        return None, "model"
+    if _GOLD_NUMBER.match(target):
+        grade = _grade_number(target, predicted_answer)
+        return (grade, "rule:numeric") if grade is not None else (None, "model")
+    # Only the gold itself after a lead-in; "Paris Hilton" is not "Paris"
+    if _bare_answer(response) == gold:
+        return "A", "rule:contained"
+    return None, "model"
@@ -0,0 +1,132 @@
+"""
+Columnar results store: one table (see columnar.py) per run, with one row per (example, repeat)
+holding the ids, the question, gold answer and response text, the grade, and every metric and
+cost figure as a numeric column (NaN where missing). Example HTML is rendered from the table on
+demand, and the tables of many runs can be scanned together column by column.
+"""
+import ast
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Sequence, Union
+
+import numpy as np
+
+import columnar
+from simpleqa_eval import COST_FIELDS, SimpleQAEval, cost_metrics, record_example, record_key
+
+STRING_COLUMNS = [
+    "run", "example_id", "problem", "answer", "response", "grade", "graded_by", "topic", "answer_type", "metadata",
+    "response_metadata"
+]
+
+
+def table_dir(results_stem: Path) -> Path:
+    return results_stem.with_name(results_stem.name + "_table")
+
+
+def write_results_table(
+    directory: Union[str, Path],
+    responses: Iterable[Dict],
+    grades: Iterable[Dict],
+    run: Union[str, None] = None
+) -> Path:
+    """
+    Write the graded `responses` as a results table. `run` labels every row (default: the table's
+    directory name without its "_table" suffix). Responses without a grade are left out.
+    """
+    directory = Path(directory)
+    run = run or directory.name.removesuffix("_table")
+    grades = {record_key(grade): grade for grade in grades}
+    strings = {name: [] for name in STRING_COLUMNS}
+    repeats = []
+    numbers = []
+    for response in responses:
+        grade = grades.get(record_key(response))
+        if grade is None:
+            continue
+        metadata = response.get("metadata") or {}
+        parsed = ast.literal_eval(metadata) if isinstance(metadata, str) else metadata
+        row = {
+            "run": run,
+            "example_id": record_example(response),
+            "problem": response["problem"],
+            "answer": response["answer"],
+            "response": response["response"],
+            "grade": grade["grade"],
+            "graded_by": grade.get("graded_by") or "",
+            "topic": parsed.get("topic", ""),
+            "answer_type": parsed.get("answer_type", ""),
+            "metadata": metadata,
+            # As JSON, so the report shows the cost exactly as the responses file has it
+            "response_metadata": json.dumps(response.get("response_metadata") or {}),
+        }
+        for name in STRING_COLUMNS:
+            strings[name].append(row[name])
+        repeats.append(response.get("repeat", 0))
+        numbers.append(
+            grade["metrics"] | cost_metrics(response.get("response_metadata"))
+            | cost_metrics(grade.get("grader_metadata"), prefix="grader_")
+        )
+
+    columns = dict(strings)
+    columns["repeat"] = np.array(repeats, dtype=np.int64)
+    for name in sorted({name for row in numbers for name in row}):
+        columns[name] = np.array([row.get(name, np.nan) for row in numbers], dtype=float)
+    columnar.write_table(directory, columns)
+    return directory
+
+
+def example_htmls(table: Dict[str, Sequence]) -> Iterator[str]:
+    """
+    Render the HTML of each row of a results table, one row at a time, as the report built from the
+    responses file shows it. The conversation is the problem as the only message, as it was sampled;
+    tables written without the response metadata fall back to the numeric cost columns.
+    """
+    cost_columns = [name for name in COST_FIELDS + ["compute_time"] if name in table]
+    for i in range(len(table["grade"])):
+        prompt_messages = [{"role": "user", "content": table["problem"][i]}]
+        if "response_metadata" in table:
+            cost = json.loads(table["response_metadata"][i])
+        else:
+            cost = {name: float(table[name][i]) for name in cost_columns if not np.isnan(table[name][i])}
+        yield SimpleQAEval.example_html(
+            prompt_messages, table["response"][i], table["answer"][i], score=table["grade"][i] == "A", cost=cost
+        )
+
+
+def scan(directories: Iterable[Union[str, Path]], columns: Union[List[str], None] = None) -> Dict[str, np.ndarray]:
+    """
+    Concatenate `columns` of several results tables (default: the columns they all have). String
+    columns become object arrays and numeric columns missing from a table are filled with NaN.
+    """
+    tables = [columnar.read_table(directory) for directory in directories]
+    assert tables, "No results tables to scan"
+    if columns is None:
+        columns = [name for name in tables[0] if all(name in table for table in tables)]
+    scanned = {}
+    for name in columns:
+        parts = []
+        for table in tables:
+            if name in STRING_COLUMNS:
+                parts.append(np.array(list(table[name]), dtype=object))
+            elif name in table:
+                parts.append(np.asarray(table[name]))
+            else:
+                parts.append(np.full(len(table["grade"]), np.nan))
+        scanned[name] = np.concatenate(parts)
+    return scanned
+
+
+def group_means(columns: Dict[str, np.ndarray], by: str, metrics: List[str]) -> Dict[str, Dict[str, float]]:
+    """
+    Mean of each of `metrics` (ignoring NaN) per value of the column `by`, with the row count as "n".
+    """
+    labels, inverse = np.unique(columns[by].astype(str), return_inverse=True)
+    groups = {}
+    for i, label in enumerate(labels):
+        mask = inverse == i
+        groups[label] = {"n": int(mask.sum())}
+        for name in metrics:
+            values = columns[name][mask].astype(float)
+            groups[label][name] = float(np.nanmean(values)) if not np.isnan(values).all() else float("nan")
+    return groups
@@ -0,0 +1,306 @@
+"""
+Resident-model sampler daemon. A long-lived process keeps HFChatCompletionSampler models loaded and
+serves them over a local Unix socket, so repeated CLI runs attach to an already loaded model instead
+of loading it again:
+
+    python simpleqa_eval_hf.py daemon [--max_resident_models 2] [--low_cpu_mem_usage]
+
+The protocol is one JSON object per line. A connection first attaches to a model with its load and
+generation settings; models are shared by every connection with the same load settings (model,
+directory, device, dtype, quantization) and each connection gets its own generation settings.
+The client side (DaemonSampler) imports neither torch nor transformers.
+"""
+import copy
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+from classes import MessageList, SamplerBase, SamplerResponse
+
+DEFAULT_SOCKET = Path(os.environ.get("SIMPLEQA_DAEMON_SOCKET", Path.home() / ".cache" / "simpleqa" / "sampler.sock"))
+
+# Settings that identify a loaded model; everything else in a config is a generation setting
+LOAD_FIELDS = ("model", "model_dir", "device", "dtype", "quantize", "draft_model")
+GENERATION_FIELDS = (
+    "system_message", "max_tokens", "temperature", "batch_size", "sort_by_length", "stop", "stop_token_ids",
+    "profile_dir", "profile_every"
+)
+
+
+class _Resident:
+    def __init__(self, sampler, load_time: float):
+        self.sampler = sampler
+        self.load_time = load_time
+        # One batch at a time per model, whichever connection it comes from
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class SamplerDaemon:
+    """
+    Keeps up to `max_resident_models` models loaded, evicting the least recently used model that no
+    connection is attached to when another one is needed.
+    """
+
+    def __init__(
+        self,
+        max_resident_models: int = 2,
+        low_cpu_mem_usage: bool = False,
+        num_threads: Union[int, None] = None,
+        num_interop_threads: Union[int, None] = None
+    ):
+        self.max_resident_models = max(1, max_resident_models)
+        self.low_cpu_mem_usage = low_cpu_mem_usage
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        idle = sorted(
+            (key for key, resident in self.models.items() if resident.users == 0),
+            key=lambda key: self.models[key].last_used
+        )
+        while len(self.models) >= self.max_resident_models and idle:
+            key = idle.pop(0)
+            self.models.pop(key).sampler.unload()
+            print(f"Evicted {key}")
+
+    def attach(self, config: Dict) -> Tuple[_Resident, SamplerBase, bool]:
+        """
+        The resident model for `config` (loaded if needed), a view of it with the config's generation
+        settings, and whether it was loaded by this call.
+        """
+        from hf_chat_completion_sampler import HFChatCompletionSampler
+
+        key = json.dumps({field: config.get(field) for field in LOAD_FIELDS}, sort_keys=True)
+        with self._lock:
+            loaded = key not in self.models
+            if loaded:
+                self._evict()
+                print(f"Loading {key}")
+                start = time.perf_counter()
+                sampler = HFChatCompletionSampler(
+                    **{field: config.get(field) for field in LOAD_FIELDS},
+                    num_threads=self.num_threads,
+                    num_interop_threads=self.num_interop_threads,
+                    low_cpu_mem_usage=self.low_cpu_mem_usage
+                )
+                self.models[key] = _Resident(sampler, time.perf_counter() - start)
+                print(f"Loaded {key} in {self.models[key].load_time:.1f}s")
+            resident = self.models[key]
+            resident.users += 1
+
+        view = copy.copy(resident.sampler)
+        view.configure(**{field: config[field] for field in GENERATION_FIELDS if config.get(field) is not None})
+        return resident, view, loaded
+
+    def detach(self, resident: _Resident):
+        with self._lock:
+            resident.users -= 1
+            resident.last_used = time.monotonic()
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "models": [
+                    {"key": key, "users": resident.users, "load_time": resident.load_time}
+                    for key, resident in self.models.items()
+                ],
+            }
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _send(self, message: Dict):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        daemon = self.server.sampler_daemon
+        resident, view = None, None
+        try:
+            for line in self.rfile:
+                request = json.loads(line)
+                op = request["op"]
+                try:
+                    if op == "attach":
+                        if resident is not None:
+                            daemon.detach(resident)
+                        resident, view, loaded = daemon.attach(request["config"])
+                        self._send({
+                            "model_name": view.model_name, "identity": view.cache_identity(),
+                            "loaded": loaded, "load_time": resident.load_time
+                        })
+                    elif op == "status":
+                        self._send(daemon.status())
+                    elif op == "shutdown":
+                        self._send({"ok": True})
+                        threading.Thread(target=self.server.shutdown, daemon=True).start()
+                        return
+                    elif view is None:
+                        raise ValueError(f"Attach to a model before {op=}")
+                    elif op == "imap_batch":
+                        # The lock is taken per batch, so other connections' batches interleave
+                        results = view.imap_batch(request["message_lists"])
+                        while True:
+                            with resident.lock:
+                                result = next(results, None)
+                            if result is None:
+                                break
+                            self._send({"index": result[0], "response": asdict(result[1])})
+                        self._send({"done": True})
+                    elif op == "sample_batch":
+                        with resident.lock:
+                            responses = view.sample_batch(request["message_lists"])
+                        self._send({"responses": [asdict(response) for response in responses]})
+                    elif op == "score_choices_batch":
+                        with resident.lock:
+                            scored = view.score_choices_batch_with_metadata(
+                                request["message_lists"], request["choices"]
+                            )
+                        self._send({"scores": [probs for probs, _ in scored], "metadata": [meta for _, meta in scored]})
+                    elif op == "cache_prefix":
+                        with resident.lock:
+                            view.cache_prefix(request["prefix"])
+                        self._send({"ok": True})
+                    else:
+                        raise ValueError(f"Unknown {op=}")
+                except Exception as e:
+                    self._send({"error": f"{type(e).__name__}: {e}"})
+        finally:
+            if resident is not None:
+                daemon.detach(resident)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def daemon_running(socket_path: Union[str, Path, None] = None) -> bool:
+    """
+    Whether a daemon is listening on `socket_path` (a leftover socket file of a dead daemon is not).
+    """
+    socket_path = socket_path or DEFAULT_SOCKET
+    if not Path(socket_path).exists():
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            return False
+    return True
+
+
+def serve(socket_path: Union[str, Path, None], daemon: SamplerDaemon):
+    """
+    Serve `daemon` on `socket_path` until a shutdown request or an interrupt.
+    """
+    socket_path = Path(socket_path or DEFAULT_SOCKET)
+    assert not daemon_running(socket_path), f"A daemon is already listening on {socket_path}"
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    socket_path.unlink(missing_ok=True)
+    with _Server(str(socket_path), _Handler) as server:
+        server.sampler_daemon = daemon
+        print(f"Sampler daemon listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+    print("Sampler daemon stopped")
+
+
+class DaemonSampler(SamplerBase):
+    """
+    Sampler backed by a model resident in a sampler daemon. `config` holds the model's load and
+    generation settings, as HFChatCompletionSampler arguments. Unloading only closes the connection;
+    the model stays loaded in the daemon for the next run.
+    """
+
+    def __init__(self, config: Dict, socket_path: Union[str, Path, None] = None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(str(socket_path or DEFAULT_SOCKET))
+        self._file = self._sock.makefile("rwb")
+        self._lock = threading.Lock()
+        reply = self._request({"op": "attach", "config": config})
+        self.model_name = reply["model_name"]
+        self._identity = reply["identity"]
+        state = "newly loaded" if reply["loaded"] else "resident"
+        print(f"Attached to {state} model {self.model_name} in the sampler daemon")
+
+    def cache_identity(self) -> Dict:
+        return self._identity
+
+    def _pack_message(self, role: str, content: Any) -> Dict:
+        return {"role": str(role), "content": str(content)}
+
+    def _send(self, message: Dict):
+        self._file.write((json.dumps(message) + "\n").encode("utf-8"))
+        self._file.flush()
+
+    def _receive(self) -> Dict:
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("The sampler daemon closed the connection")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(f"Sampler daemon: {reply['error']}")
+        return reply
+
+    def _request(self, message: Dict) -> Dict:
+        with self._lock:
+            self._send(message)
+            return self._receive()
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        return self.sample_batch([message_list])[0]
+
+    def imap_batch(self, message_lists: List[MessageList]) -> Iterator[Tuple[int, SamplerResponse]]:
+        with self._lock:
+            self._send({"op": "imap_batch", "message_lists": message_lists})
+            while not (reply := self._receive()).get("done"):
+                yield reply["index"], SamplerResponse(**reply["response"])
+
+    def sample_batch(self, message_lists: List[MessageList]) -> List[SamplerResponse]:
+        reply = self._request({"op": "sample_batch", "message_lists": message_lists})
+        return [SamplerResponse(**response) for response in reply["responses"]]
+
+    def score_choices(self, message_list: MessageList, choices: List[str]) -> List[float]:
+        return self.score_choices_batch([message_list], choices)[0]
+
+    def score_choices_batch_with_metadata(
+        self, message_lists: List[MessageList], choices: List[str]
+    ) -> List[Tuple[List[float], Dict]]:
+        reply = self._request({"op": "score_choices_batch", "message_lists": message_lists, "choices": choices})
+        return list(zip(reply["scores"], reply["metadata"]))
+
+    def score_choices_batch(self, message_lists: List[MessageList], choices: List[str]) -> List[List[float]]:
+        return [probs for probs, _ in self.score_choices_batch_with_metadata(message_lists, choices)]
+
+    def cache_prefix(self, prefix: str) -> None:
+        self._request({"op": "cache_prefix", "prefix": prefix})
+
+    def unload(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+
+def request_daemon(message: Dict, socket_path: Union[str, Path, None] = None) -> Dict:
+    """
+    Send one control request (status, shutdown) to the daemon and return its reply.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path or DEFAULT_SOCKET))
+        with sock.makefile("rwb") as fh:
+            fh.write((json.dumps(message) + "\n").encode("utf-8"))
+            fh.flush()
+            return json.loads(fh.readline())
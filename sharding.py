@@ -0,0 +1,108 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import List, Sequence, Union
+
+import common
+from simpleqa_eval import record_key
+
+
+def shard(items: Sequence, num_shards: int, shard_id: int) -> List:
+    """
+    Deterministic round-robin slice of `items` for one shard.
+    """
+    assert 0 <= shard_id < num_shards, f"shard_id must be in [0, {num_shards})"
+    return list(items[shard_id::num_shards])
+
+
+def shard_path(path: Path, num_shards: int, shard_id: int) -> Path:
+    return path.with_name(f"{path.stem}.shard{shard_id}of{num_shards}{path.suffix}")
+
+
+def parse_cpu_set(cpu_set: str) -> List[int]:
+    """
+    Parse a core list such as "0-7,16-23" into core ids.
+    """
+    cores = []
+    for part in cpu_set.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def pin_cpu_set(cpu_set: Union[str, None]):
+    """
+    Pin the calling thread, and the threads it starts from now on, to the cores of `cpu_set`.
+    """
+    if cpu_set:
+        os.sched_setaffinity(0, parse_cpu_set(cpu_set))
+
+
+def launch_shards(
+    argv: List[str],
+    num_shards: int,
+    devices: Union[List[str], None] = None,
+    cpu_sets: Union[List[str], None] = None
+) -> List[int]:
+    """
+    Run `argv` once per shard with --num_shards/--shard_id appended, each worker pinned to
+    devices[i] (through CUDA_VISIBLE_DEVICES) and/or cpu_sets[i] (through CPU affinity),
+    cycling through the lists when there are more shards than entries. Returns the exit codes.
+    """
+    workers = []
+    try:
+        for shard_id in range(num_shards):
+            env = os.environ.copy()
+            preexec_fn = None
+            if devices:
+                env["CUDA_VISIBLE_DEVICES"] = devices[shard_id % len(devices)]
+            if cpu_sets:
+                cores = parse_cpu_set(cpu_sets[shard_id % len(cpu_sets)])
+                env["OMP_NUM_THREADS"] = str(len(cores))
+                preexec_fn = (lambda cores: lambda: os.sched_setaffinity(0, cores))(cores)
+            cmd = [sys.executable] + argv + ["--num_shards", str(num_shards), "--shard_id", str(shard_id)]
+            print(f"Launching shard {shard_id}: {' '.join(cmd)}")
+            workers.append(subprocess.Popen(cmd, env=env, preexec_fn=preexec_fn))
+        return [worker.wait() for worker in workers]
+    finally:
+        # A failed launch or an interrupt must not leave the workers already started running
+        stop_workers(workers)
+
+
+def stop_workers(workers: List[subprocess.Popen], timeout: float = 10.0):
+    """
+    Terminate the workers still running, killing those that do not exit within `timeout` seconds.
+    """
+    running = [worker for worker in workers if worker.poll() is None]
+    for worker in running:
+        worker.terminate()
+    for worker in running:
+        try:
+            worker.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+            worker.wait()
+
+
+def merge_shards(path: Path, num_shards: int) -> Path:
+    """
+    Combine the per-shard JSONL files of `path` into `path`, dropping duplicate records.
+    """
+    seen = set()
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    with common.JSONLWriter(tmp_path, fsync_every=1000) as writer:
+        for shard_id in range(num_shards):
+            shard_file = shard_path(path, num_shards, shard_id)
+            assert shard_file.exists(), f"Missing shard file {shard_file}"
+            for record in common.read_jsonl(shard_file):
+                if record_key(record) not in seen:
+                    seen.add(record_key(record))
+                    writer.write(record)
+    os.replace(tmp_path, path)
+    print(f"Merged {num_shards} shards ({len(seen)} records) into {path}")
+    return path
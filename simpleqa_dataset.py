@@ -0,0 +1,78 @@
+import csv
+import hashlib
+import io
+import os
+import urllib.request
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, Union
+
+import columnar
+
+
+DEFAULT_DATASET_URL = "https://openaipublic.blob.core.windows.net/simple-evals/simple_qa_test_set.csv"
+DEFAULT_CACHE_DIR = Path(os.environ.get("SIMPLEQA_CACHE_DIR", Path.home() / ".cache" / "simpleqa"))
+COLUMNS = ["metadata", "problem", "answer"]
+
+
+class SimpleQAExamples(Sequence):
+    """
+    Read-only view of the SimpleQA examples in a columnar cache. Examples are decoded on access.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.columns = columnar.read_table(directory)
+
+    def __len__(self) -> int:
+        return len(self.columns["problem"])
+
+    def __getitem__(self, i: int) -> Dict[str, str]:
+        return {name: column[i] for name, column in self.columns.items()}
+
+
+def _is_url(path: str) -> bool:
+    return path.startswith(("http://", "https://"))
+
+
+def _cache_key(source: str) -> str:
+    key = source
+    if not _is_url(source):
+        # Re-convert local files whenever they change
+        stat = os.stat(source)
+        key = f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def _read_csv(source: str) -> Dict[str, list]:
+    if _is_url(source):
+        # Bypass Azure Blob Storage authentication
+        with urllib.request.urlopen(source) as response:
+            text = response.read().decode("utf-8")
+    else:
+        with open(source, encoding="utf-8", newline="") as fh:
+            text = fh.read()
+
+    columns = {name: [] for name in COLUMNS}
+    for row in csv.DictReader(io.StringIO(text, newline="")):
+        for name in COLUMNS:
+            columns[name].append(row[name])
+    return columns
+
+
+def load_examples(
+    dataset_path: Union[str, Path, None] = None,
+    cache_dir: Union[str, Path, None] = None
+) -> SimpleQAExamples:
+    """
+    Load the SimpleQA examples from `dataset_path`, a CSV URL, a local CSV file or an already converted
+    cache directory. CSVs are converted once into a memory-mapped columnar cache under `cache_dir`,
+    so later loads need neither the network nor CSV parsing.
+    """
+    source = str(dataset_path or DEFAULT_DATASET_URL)
+    if not _is_url(source) and columnar.is_table(source):
+        return SimpleQAExamples(source)
+
+    directory = Path(cache_dir or DEFAULT_CACHE_DIR) / _cache_key(source)
+    if not columnar.is_table(directory):
+        columnar.write_table(directory, _read_csv(source))
+    return SimpleQAExamples(directory)
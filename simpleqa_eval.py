@@ -1,10 +1,19 @@
+import ast
+import hashlib
+import json
 import random
 import re
-import pandas as pd
+from pathlib import Path
+from collections.abc import Sequence
+import numpy as np
 from tqdm import tqdm
-from typing import List, Dict, Union
+from typing import Callable, List, Dict, Tuple, Union
 import common
+import simpleqa_dataset
+from cascade_grader import CascadeGrader
 from classes import SamplerBase, EvalResult, SingleEvalResult, Eval
+from grade_cache import GradeCache
+from pregrader import pregrade as rule_pregrade
 
 
 GRADER_TEMPLATE = """
@@ -73,134 +82,665 @@ Also note the following things:
     - For example, if the gold target is "Hyung Won Chung", you can consider the following predicted answers as correct: "Hyoong Won Choong", "Hyungwon Chung", or "Hyun Won Chung".
 
 
-Here is a new example. Simply reply with either CORRECT, INCORRECT, NOT ATTEMPTED. Don't apologize or correct yourself if there was a mistake; we are just trying to grade the answer.
+Grade the predicted answer of the new question below as one of:
+A: CORRECT
+B: INCORRECT
+C: NOT_ATTEMPTED
+
+Just return the letters "A", "B", or "C", with no text around it. Don't apologize or correct yourself if there was a mistake; we are just trying to grade the answer.
+
+
+Here is a new example.
 ```
 Question: {question}
 Gold target: {target}
 Predicted answer: {predicted_answer}
 ```
+""".strip()
 
-Grade the predicted answer of this new question as one of:
-A: CORRECT
-B: INCORRECT
-C: NOT_ATTEMPTED
+# Everything before the question is identical across grading requests, so its KV cache can be reused.
+# Keep the template's variable fields strictly at the end.
+GRADER_PREFIX = GRADER_TEMPLATE[:GRADER_TEMPLATE.index("Question: {question}")]
+# Changes whenever the template text changes, invalidating cached grades
+GRADER_TEMPLATE_VERSION = hashlib.sha256(GRADER_TEMPLATE.encode("utf-8")).hexdigest()[:12]
 
-Just return the letters "A", "B", or "C", with no text around it.
-""".strip()
+CHOICE_LETTERS = ["A", "B", "C"]
+GRADING_MODES = ["generate", "logits"]
+# Per-example cost figures from the samplers' response metadata, rolled up into percentiles
+COST_FIELDS = [
+    "prompt_tokens", "completion_tokens", "queue_time", "prefill_time", "decode_time", "latency",
+    "draft_tokens", "draft_accepted_tokens", "target_forwards"
+]
+COST_STATS = ("mean", "p50", "p95")
 
 
-class SimpleQAEval(Eval):
-    # Bypass Azure Blob Storage authentication
-    df = pd.read_csv(
-        "https://openaipublic.blob.core.windows.net/simple-evals/simple_qa_test_set.csv"
+def example_id(example: Dict) -> str:
+    """
+    Stable id of a dataset example, derived from its question text.
+    """
+    return hashlib.sha1(example["problem"].encode("utf-8")).hexdigest()[:16]
+
+
+def simpleqa_metrics(is_correct, is_incorrect) -> Dict[str, np.ndarray]:
+    """
+    SimpleQA metrics from the fraction of correct and incorrect grades. Works elementwise on arrays,
+    e.g. on the means of many bootstrap resamples at once.
+    """
+    is_correct = np.asarray(is_correct, dtype=float)
+    is_incorrect = np.asarray(is_incorrect, dtype=float)
+    is_given_attempted = is_correct + is_incorrect
+    accuracy_given_attempted = np.divide(
+        is_correct, is_given_attempted, out=np.zeros_like(is_correct), where=is_given_attempted > 0
     )
-    all_examples = [row.to_dict() for _, row in df.iterrows()]
+    f1_denominator = accuracy_given_attempted + is_correct
+    f1 = np.divide(
+        2 * accuracy_given_attempted * is_correct, f1_denominator,
+        out=np.zeros_like(is_correct), where=f1_denominator > 0
+    )
+    return {
+        "is_correct": is_correct,
+        "is_incorrect": is_incorrect,
+        "is_not_attempted": 1 - is_given_attempted,
+        "is_given_attempted": is_given_attempted,
+        "accuracy_given_attempted": accuracy_given_attempted,
+        "f1": f1,
+    }
+
+
+def cost_metrics(metadata: Union[Dict, None], prefix: str = "") -> Dict[str, float]:
+    """
+    Per-example cost metrics from a sampler's response metadata. "compute_time" is the example's
+    share of its batch's latency, so throughput is total tokens over total compute time.
+    """
+    metadata = metadata or {}
+    metrics = {f"{prefix}{name}": metadata[name] for name in COST_FIELDS if metadata.get(name) is not None}
+    if metadata.get("latency") is not None:
+        metrics[f"{prefix}compute_time"] = metadata["latency"] / metadata.get("batch_size", 1)
+    return metrics
+
+
+def grader_identity(grader_model: SamplerBase, grading_mode: str) -> str:
+    """
+    Canonical identity of a grader for grade cache keys: its model, precision and, when grades are
+    sampled, its temperature.
+    """
+    identity = dict(grader_model.cache_identity())
+    if grading_mode == "logits":
+        # Scoring is deterministic, whatever the temperature
+        identity.pop("temperature", None)
+    return json.dumps(identity, sort_keys=True)
+
+
+def record_example(record: Dict) -> str:
+    """
+    Example id of a response or grade record, shared by all its repeats.
+    """
+    return record.get("example_id") or example_id(record)
+
+
+def record_key(record: Dict) -> str:
+    """
+    Key identifying a response or grade record across reruns: example id plus repeat index.
+    """
+    return f"{record_example(record)}/{record.get('repeat', 0)}"
+
+
+def records_by_key(path: Union[str, Path, None]) -> Dict[str, Dict]:
+    """
+    The records of a responses or grades file by record key (none if there is no file).
+    """
+    if not path or not Path(path).exists():
+        return {}
+    return {record_key(record): record for record in common.read_jsonl(path)}
+
+
+class SimpleQAEval(Eval):
+    # Loaded on first use rather than at import
+    _examples = None
+    _dataset_source = None
 
     @staticmethod
-    def generate_responses(model: SamplerBase, num_examples: Union[int, None] = None, n_repeats: int = 1) -> List[Dict]:
-        examples = SimpleQAEval.all_examples
+    def load_dataset(
+        dataset_path: Union[str, Path, None] = None,
+        cache_dir: Union[str, Path, None] = None
+    ) -> Sequence:
+        # Reloading the same dataset (e.g. once per model of a sweep) reuses the loaded examples
+        if SimpleQAEval._examples is None or SimpleQAEval._dataset_source != (dataset_path, cache_dir):
+            SimpleQAEval._examples = simpleqa_dataset.load_examples(dataset_path, cache_dir)
+            SimpleQAEval._dataset_source = (dataset_path, cache_dir)
+        return SimpleQAEval._examples
+
+    @staticmethod
+    def get_examples() -> Sequence:
+        if SimpleQAEval._examples is None:
+            SimpleQAEval.load_dataset()
+        return SimpleQAEval._examples
+
+    @staticmethod
+    def generate_responses(
+        model: SamplerBase,
+        num_examples: Union[int, None] = None,
+        n_repeats: int = 1,
+        output_file: Union[str, Path, None] = None,
+        num_shards: int = 1,
+        shard_id: int = 0,
+        on_response: Union[Callable[[Dict], None], None] = None,
+        examples: Union[Sequence, None] = None,
+        done: Union[Dict[str, Dict], None] = None
+    ) -> List[Dict]:
+        """
+        Generate a response per example. If `output_file` is given, each record is appended to it
+        as soon as it completes and records already present in it are reused instead of regenerated.
+        With `n_repeats` > 1 each example is sampled that many times; the repeats of an example are
+        adjacent, so batching samplers can prefill their shared prompt once.
+        With `num_shards` > 1 only the examples of shard `shard_id` are generated.
+        `on_response` is called with every completed record, reused ones first, as soon as it is ready.
+        `examples` replaces the dataset examples (and `num_examples` sampling) when given.
+        `done` holds the records already in `output_file` (see records_by_key), so callers generating
+        in rounds read the file once; the new records are added to it.
+        """
+        if examples is None:
+            examples = SimpleQAEval.get_examples()
+        elif num_examples:
+            raise ValueError("num_examples cannot be combined with explicit examples")
         if num_examples:
-            assert n_repeats == 1, "n_repeats only supported when max_examples = None"
             rng = random.Random(0)
-            examples = rng.sample(SimpleQAEval.all_examples, num_examples)
-        examples = examples * n_repeats
-
-        responses = []
-        for ex in tqdm(examples):
-            prompt_messages = [
-                model._pack_message(content=ex["problem"], role="user")
-            ]
-            response = model(prompt_messages)
-            responses.append({
-                "prompt_messages": prompt_messages,
+            examples = rng.sample(examples, num_examples)
+        # Shards split examples, never the repeats of one example
+        examples = list(examples)[shard_id::num_shards]
+        examples = [(ex, repeat) for ex in examples for repeat in range(n_repeats)]
+
+        responses = [
+            {
+                "example_id": example_id(ex),
+                "repeat": repeat,
+                "prompt_messages": [model._pack_message(content=ex["problem"], role="user")],
                 "problem": ex["problem"],
                 "answer": ex["answer"],
-                "response": response
-            })
+                "metadata": ex["metadata"],
+            }
+            for ex, repeat in examples
+        ]
+
+        if done is None:
+            done = records_by_key(output_file)
+        pending = []
+        for i, record in enumerate(responses):
+            if record_key(record) in done:
+                responses[i] = done[record_key(record)]
+            else:
+                pending.append(i)
+        if len(pending) < len(responses):
+            print(f"Resuming: {len(responses) - len(pending)}/{len(responses)} responses already in {output_file}")
+            if on_response:
+                for record in responses:
+                    if record_key(record) in done:
+                        on_response(record)
+
+        writer = common.JSONLWriter(output_file) if output_file else None
+        try:
+            # Samplers that batch may complete requests out of order; slot each response by index
+            with tqdm(total=len(pending)) as pbar:
+                prompts = [responses[i]["prompt_messages"] for i in pending]
+                for j, response in model.imap_batch(prompts):
+                    record = responses[pending[j]]
+                    record["response"] = response.response_text
+                    record["response_metadata"] = response.response_metadata
+                    done[record_key(record)] = record
+                    if writer:
+                        writer.write(record)
+                    if on_response:
+                        on_response(record)
+                    pbar.update(1)
+        finally:
+            if writer:
+                writer.close()
         return responses
 
     @staticmethod
-    def grade_response(grader_model: SamplerBase, question: str, target: str, predicted_answer: str) -> str:
+    def _grader_prompt(grader_model: SamplerBase, question: str, target: str, predicted_answer: str) -> List[Dict]:
         grader_prompt = GRADER_TEMPLATE.format(
             question=question,
             target=target,
             predicted_answer=predicted_answer,
         )
+        return [grader_model._pack_message(content=grader_prompt, role="user")]
 
-        prompt_messages = [
-            grader_model._pack_message(content=grader_prompt, role="user")
-        ]
+    @staticmethod
+    def grade_response(
+        grader_model: SamplerBase, question: str, target: str, predicted_answer: str
+    ) -> Tuple[str, Dict]:
+        """
+        Return the grade letter and the grader's response metadata.
+        """
+        prompt_messages = SimpleQAEval._grader_prompt(grader_model, question, target, predicted_answer)
         grading_response = grader_model(prompt_messages)
 
-        match = re.search(r"(A|B|C)", grading_response)
+        match = re.search(r"(A|B|C)", grading_response.response_text)
         # Default to "NOT_ATTEMPTED" if no match
-        return match.group(0) if match else "C"
+        return (match.group(0) if match else "C"), grading_response.response_metadata
+
+    @staticmethod
+    def score_response(
+        grader_model: SamplerBase, question: str, target: str, predicted_answer: str
+    ) -> Tuple[Dict[str, float], Dict]:
+        """
+        Grade with a single forward pass, returning the grader's probability for each grade letter
+        and the metadata of the pass (prompt tokens and times, as for a sampled grade).
+        """
+        prompt_messages = SimpleQAEval._grader_prompt(grader_model, question, target, predicted_answer)
+        probs, metadata = grader_model.score_choices_with_metadata(prompt_messages, CHOICE_LETTERS)
+        return dict(zip(CHOICE_LETTERS, probs)), metadata
+
+    @staticmethod
+    def grade_cascade(cascade: CascadeGrader, response: Dict) -> Tuple[str, Dict[str, float], str, Dict]:
+        """
+        Score the response with each tier of `cascade` in turn until one is confident enough (its
+        highest grade probability reaches the threshold); the last tier always decides. Returns the
+        grade letter, its metrics, the "graded_by" name of the deciding tier and the cost of all the
+        passes. An audited response decided before the last tier is also scored by the last tier,
+        recording `audit_agreement`.
+        """
+        question, target, predicted_answer = response["problem"], response["answer"], response["response"]
+        last = len(cascade) - 1
+        passes = []
+        for tier in range(len(cascade)):
+            grader = cascade.tier(tier)
+            grade_probs, metadata = SimpleQAEval.score_response(grader, question, target, predicted_answer)
+            passes.append(metadata)
+            grade_letter = max(grade_probs, key=grade_probs.get)
+            if grade_probs[grade_letter] >= cascade.threshold:
+                break
+
+        grade_metrics = {
+            "p_correct": grade_probs["A"],
+            "p_incorrect": grade_probs["B"],
+            "p_not_attempted": grade_probs["C"],
+            "grade_confidence": grade_probs[grade_letter],
+            "cascade_tier": tier,
+        } | {f"resolved_tier_{i}": i == tier for i in range(len(cascade))}
+        if tier < last and cascade.audited(record_key(response)):
+            grader = cascade.tier(last)
+            audit_probs, metadata = SimpleQAEval.score_response(grader, question, target, predicted_answer)
+            passes.append(metadata)
+            grade_metrics["audit_agreement"] = max(audit_probs, key=audit_probs.get) == grade_letter
+        # Summed over the passes, each taking its share of its batch's latency, so compute time adds up across tiers
+        grader_metadata = {}
+        if all(metadata.get("prompt_tokens") is not None for metadata in passes):
+            grader_metadata["prompt_tokens"] = sum(metadata["prompt_tokens"] for metadata in passes)
+        if all(metadata.get("latency") is not None for metadata in passes):
+            grader_metadata["latency"] = sum(metadata["latency"] / metadata.get("batch_size", 1) for metadata in passes)
+        return grade_letter, grade_metrics, f"cascade:{cascade.names[tier]}", grader_metadata
 
     @staticmethod
-    def evaluate(grader_model: SamplerBase, responses: List[Dict]) -> EvalResult:
-        def fn(result: Dict):
-            grade_letter = SimpleQAEval.grade_response(
+    def grade(
+        grader_model: SamplerBase,
+        response: Dict,
+        grading_mode: str = "generate",
+        grade_cache: Union[GradeCache, None] = None,
+        pregrade: bool = False
+    ) -> Dict:
+        """
+        Grade one response record, returning a grade record keyed like the response.
+        With `pregrade`, responses that a deterministic rule can decide never reach the grader.
+        Grades found in `grade_cache` are reused without calling the grader.
+        A CascadeGrader grades with its tiers in turn (see grade_cascade), whatever the grading mode.
+        The record's "graded_by" field names the rule, "cache", "model" or cascade tier that decided the grade.
+        """
+        graded_by = "model"
+        grade_letter = None
+        grader_metadata = {}
+        if pregrade:
+            grade_letter, graded_by = rule_pregrade(response["problem"], response["answer"], response["response"])
+
+        cache_key = None
+        cached = None
+        if grade_letter is None and grade_cache is not None:
+            cache_key = GradeCache.key(
+                grader_identity(grader_model, grading_mode), GRADER_TEMPLATE_VERSION,
+                grading_mode, response["problem"], response["answer"], response["response"]
+            )
+            cached = grade_cache.get(cache_key)
+
+        grade_metrics = {}
+        if cached is not None:
+            grade_letter = cached["grade"]
+            grade_metrics = cached["grade_metrics"]
+            graded_by = "cache"
+        elif grade_letter is not None:
+            pass  # decided by a rule
+        elif isinstance(grader_model, CascadeGrader):
+            grade_letter, grade_metrics, graded_by, grader_metadata = SimpleQAEval.grade_cascade(
+                grader_model, response
+            )
+        elif grading_mode == "logits":
+            grade_probs, grader_metadata = SimpleQAEval.score_response(
+                grader_model,
+                response["problem"], response["answer"], response["response"]
+            )
+            grade_letter = max(grade_probs, key=grade_probs.get)
+            grade_metrics = {
+                "p_correct": grade_probs["A"],
+                "p_incorrect": grade_probs["B"],
+                "p_not_attempted": grade_probs["C"]
+            }
+        else:
+            grade_letter, grader_metadata = SimpleQAEval.grade_response(
                 grader_model,
-                result["problem"], result["answer"], result["response"]
+                response["problem"], response["answer"], response["response"]
             )
 
+        if cache_key is not None and cached is None:
+            grade_cache.put(cache_key, {"grade": grade_letter, "grade_metrics": grade_metrics})
+
+        return {
+            "example_id": response.get("example_id") or example_id(response),
+            "repeat": response.get("repeat", 0),
+            "grade": grade_letter,
+            "graded_by": graded_by,
+            "grader_metadata": grader_metadata,
             # Metrics based on grading response
-            is_correct = grade_letter == "A"
-            is_incorrect = grade_letter == "B"
-            is_not_attempted = grade_letter == "C"
-
-            score = is_correct
-
-            # Create HTML for each sample result
-            html = common.jinja_env.from_string(common.HTML_JINJA).render(
-                prompt_messages=result["prompt_messages"],
-                next_message=dict(
-                    content=result["response"], role="assistant"),
-                score=score,
-                correct_answer=result["answer"],
-                extracted_answer=result["response"],
-            )
-            convo = result["prompt_messages"] + \
-                [dict(content=result["response"], role="assistant")]
-            return SingleEvalResult(html=html, score=score, convo=convo, metrics={
-                "is_correct": is_correct,
-                "is_incorrect": is_incorrect,
-                "is_not_attempted": is_not_attempted
-            })
-
-        results = common.map_with_progress(fn, responses)
-
-        # Aggregate metrics
-        aggregate_metrics = {
-            "is_correct": sum(result.metrics["is_correct"] for result in results) / len(results),
-            "is_incorrect": sum(result.metrics["is_incorrect"] for result in results) / len(results),
-            "is_not_attempted": sum(result.metrics["is_not_attempted"] for result in results) / len(results),
+            "metrics": {
+                "is_correct": grade_letter == "A",
+                "is_incorrect": grade_letter == "B",
+                "is_not_attempted": grade_letter == "C"
+            } | grade_metrics | ({"pregraded": graded_by.startswith("rule:")} if pregrade else {})
         }
-        aggregate_metrics["is_given_attempted"] = aggregate_metrics["is_correct"] + \
-            aggregate_metrics["is_incorrect"]
-        # Calculate accuracy_given_attempted
-        aggregate_metrics["accuracy_given_attempted"] = (
-            aggregate_metrics["is_correct"]
-            / aggregate_metrics["is_given_attempted"]
-            if aggregate_metrics["is_given_attempted"] > 0
-            else 0
+
+    @staticmethod
+    def single_eval_result(response: Dict, grade: Dict) -> SingleEvalResult:
+        """
+        Per-example score and metrics only; the example's HTML is rendered later, from the results
+        table (see results_store.example_htmls).
+        """
+        metrics = grade["metrics"] | cost_metrics(response.get("response_metadata")) \
+            | cost_metrics(grade.get("grader_metadata"), prefix="grader_")
+        return SingleEvalResult(score=grade["grade"] == "A", metrics=metrics)
+
+    @staticmethod
+    def example_html(
+        prompt_messages: List[Dict],
+        response: str,
+        answer: str,
+        score: bool,
+        cost: Union[Dict, None] = None
+    ) -> str:
+        return common.get_template(common.HTML_JINJA).render(
+            prompt_messages=prompt_messages,
+            next_message=dict(content=response, role="assistant"),
+            score=score,
+            correct_answer=answer,
+            extracted_answer=response,
+            cost=cost,
+        )
+
+    @staticmethod
+    def grade_all(
+        grader_model: SamplerBase,
+        responses: List[Dict],
+        grading_mode: str = "generate",
+        grades_file: Union[str, Path, None] = None,
+        grade_cache: Union[GradeCache, None] = None,
+        pregrade: bool = False,
+        graded: Union[Dict[str, Dict], None] = None,
+        prefix_cached: bool = False
+    ) -> Dict[str, Dict]:
+        """
+        Grade the responses not yet graded in `grades_file`, appending each grade to it as soon as
+        it completes. Returns the grades of all responses in the file, by record key.
+        `graded` holds the grades already in `grades_file` (see records_by_key), so callers grading in
+        rounds read the file once; the new grades are added to it and it is returned. With
+        `prefix_cached`, the grader has already cached the grader prompt prefix.
+        """
+        assert grading_mode in GRADING_MODES, f"Unknown {grading_mode=}"
+
+        grades = records_by_key(grades_file) if graded is None else graded
+        pending = [response for response in responses if record_key(response) not in grades]
+        if grades and len(pending) < len(responses):
+            print(f"Resuming: {len(responses) - len(pending)}/{len(responses)} grades already in {grades_file}")
+
+        if pending:
+            assert grader_model is not None, f"{len(pending)} responses have no grade in {grades_file}"
+            if not prefix_cached:
+                grader_model.cache_prefix(GRADER_PREFIX)
+            writer = common.JSONLWriter(grades_file) if grades_file else None
+
+            def fn(response: Dict):
+                grade = SimpleQAEval.grade(grader_model, response, grading_mode, grade_cache, pregrade)
+                if writer:
+                    writer.write(grade)
+                return grade
+
+            try:
+                for grade in common.map_with_progress(fn, pending):
+                    grades[record_key(grade)] = grade
+            finally:
+                if writer:
+                    writer.close()
+        return grades
+
+    @staticmethod
+    def evaluate(
+        grader_model: SamplerBase,
+        responses: List[Dict],
+        grading_mode: str = "generate",
+        grades_file: Union[str, Path, None] = None,
+        grade_cache: Union[GradeCache, None] = None,
+        pregrade: bool = False,
+        n_bootstrap: int = 1000
+    ) -> EvalResult:
+        """
+        Grade all responses. If `grades_file` is given, each grade is appended to it as soon as it
+        completes and responses already graded in it are not sent to the grader again.
+        If `grade_cache` is given, grades are looked up there first and its hit/miss counts are
+        added to the metrics. With `pregrade`, rule-decidable responses skip the grader and the
+        fraction decided by rules is reported as the "pregraded" metric.
+        """
+        grades = SimpleQAEval.grade_all(grader_model, responses, grading_mode, grades_file, grade_cache, pregrade)
+        results = [
+            SimpleQAEval.single_eval_result(response, grades[record_key(response)])
+            for response in responses
+        ]
+        eval_result = SimpleQAEval.aggregate(
+            results, groups=SimpleQAEval.metadata_groups(responses), n_bootstrap=n_bootstrap,
+            clusters=[record_example(response) for response in responses]
         )
-        print("AGGREGATE METRICS")
-        print(aggregate_metrics)
-        print("##################")
-
-        output_d = {
-            "accuracy_given_attempted": aggregate_metrics["accuracy_given_attempted"],
-            "f1": (
-                2 * aggregate_metrics["accuracy_given_attempted"] *
-                aggregate_metrics["is_correct"]
-                / (aggregate_metrics["accuracy_given_attempted"] + aggregate_metrics["is_correct"])
-                if (aggregate_metrics["accuracy_given_attempted"] + aggregate_metrics["is_correct"]) > 0
-                else 0
+        eval_result.metrics.update(SimpleQAEval.repeat_metrics(
+            [grades[record_key(response)] for response in responses], responses
+        ))
+        if grade_cache is not None:
+            eval_result.metrics.update(grade_cache.stats())
+        return eval_result
+
+    @staticmethod
+    def metadata_groups(records: List[Dict], fields: Sequence = ("topic", "answer_type")) -> Dict[str, List[str]]:
+        """
+        Per-record values of the dataset metadata `fields`, for breakdowns. Empty if any record
+        lacks metadata (e.g. responses files written by older versions).
+        """
+        metadata = [record.get("metadata") for record in records]
+        if not metadata or not all(metadata):
+            return {}
+        metadata = [ast.literal_eval(m) if isinstance(m, str) else m for m in metadata]
+        return {field: [str(m.get(field)) for m in metadata] for field in fields}
+
+    @staticmethod
+    def aggregate(
+        results: List[SingleEvalResult],
+        groups: Union[Dict[str, List[str]], None] = None,
+        n_bootstrap: int = 1000,
+        alpha: float = 0.05,
+        clusters: Union[List[str], None] = None
+    ) -> EvalResult:
+        """
+        Aggregate per-example results into the SimpleQA metrics, with bootstrap confidence intervals
+        (`name:ci_low`/`name:ci_high`) and, for each field in `groups`, per-value breakdowns
+        (`name[field=value]`). Results sharing a label in `clusters` (repeats of one example) are
+        resampled together.
+        """
+        name2stats = {
+            prefix + name: COST_STATS for prefix in ("", "grader_") for name in COST_FIELDS + ["compute_time"]
+        }
+        eval_result = common.aggregate_results(results, name2stats=name2stats)
+        grades = np.array(
+            [[result.metrics["is_correct"], result.metrics["is_incorrect"]] for result in results], dtype=float
+        )
+        metrics = {name: float(value) for name, value in simpleqa_metrics(*grades.mean(axis=0)).items()}
+
+        if n_bootstrap:
+            sample = grades
+            if clusters is not None and len(set(clusters)) < len(clusters):
+                # Repeats of an example are not independent: resample examples, each the mean of its repeats
+                _, inverse = np.unique(clusters, return_inverse=True)
+                sample = np.zeros((inverse.max() + 1, grades.shape[1]))
+                np.add.at(sample, inverse, grades)
+                sample /= np.bincount(inverse)[:, None]
+            resampled = common.bootstrap_means(sample, n_bootstrap)
+            for name, samples in simpleqa_metrics(resampled[:, 0], resampled[:, 1]).items():
+                low, high = np.percentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+                metrics[f"{name}:ci_low"] = float(low)
+                metrics[f"{name}:ci_high"] = float(high)
+
+        for field, labels in (groups or {}).items():
+            labels = np.asarray(labels)
+            for label in np.unique(labels):
+                mask = labels == label
+                group_metrics = simpleqa_metrics(*grades[mask].mean(axis=0))
+                metrics[f"n[{field}={label}]"] = int(mask.sum())
+                for name in ("is_correct", "accuracy_given_attempted", "f1"):
+                    metrics[f"{name}[{field}={label}]"] = float(group_metrics[name])
+
+        # Throughput over the samplers' compute time, not wall-clock time
+        for prefix in ("", "grader_"):
+            compute_time = eval_result.metrics.get(f"{prefix}compute_time")
+            if compute_time:
+                metrics[f"{prefix}examples_per_s"] = 1 / compute_time
+                completion_tokens = eval_result.metrics.get(f"{prefix}completion_tokens")
+                if completion_tokens is not None:
+                    metrics[f"{prefix}completion_tokens_per_s"] = completion_tokens / compute_time
+
+        # Speculative decoding: share of drafted tokens accepted, and tokens produced per pass of the
+        # large model (the decoding speedup over one token per pass, before the draft model's cost)
+        if eval_result.metrics.get("draft_tokens"):
+            accepted = eval_result.metrics["draft_accepted_tokens"]
+            target_forwards = eval_result.metrics["target_forwards"]
+            metrics["draft_acceptance_rate"] = accepted / eval_result.metrics["draft_tokens"]
+            metrics["tokens_per_target_forward"] = (accepted + target_forwards) / target_forwards
+
+        # Cascaded grading: the size of the audit sample behind `audit_agreement`
+        n_audited = sum("audit_agreement" in result.metrics for result in results)
+        if n_audited:
+            metrics["n_audited"] = n_audited
+
+        eval_result.metrics.update(metrics)
+        print(f"Accuracy Given Attempted: {metrics['accuracy_given_attempted']:.3f}")
+        print(f"F1 Score: {metrics['f1']:.3f}")
+        return eval_result
+
+    @staticmethod
+    def aggregate_grades(
+        grades: List[Dict],
+        responses: Union[List[Dict], None] = None,
+        n_bootstrap: int = 1000
+    ) -> Dict[str, float]:
+        """
+        Metrics from a grades file alone, without rendering any HTML. If `responses` are given,
+        they supply the metadata for the per-topic breakdowns and the generation cost metrics.
+        """
+        by_key = {record_key(response): response for response in responses or []}
+        matched = [by_key.get(record_key(grade), {}) for grade in grades]
+        results = [
+            SingleEvalResult(
+                score=grade["grade"] == "A",
+                metrics=grade["metrics"] | cost_metrics(response.get("response_metadata"))
+                | cost_metrics(grade.get("grader_metadata"), prefix="grader_")
             )
+            for grade, response in zip(grades, matched)
+        ]
+        groups = SimpleQAEval.metadata_groups(matched) if responses is not None else None
+        eval_result = SimpleQAEval.aggregate(
+            results, groups=groups, n_bootstrap=n_bootstrap, clusters=[record_example(grade) for grade in grades]
+        )
+        repeat_metrics = SimpleQAEval.repeat_metrics(grades, matched if responses is not None else None)
+        return eval_result.metrics | repeat_metrics | {"score": eval_result.score}
+
+    @staticmethod
+    def repeat_metrics(grades: List[Dict], responses: Union[List[Dict], None] = None) -> Dict[str, float]:
+        """
+        Per-question consistency over the repeated samples of each example, from the examples with
+        at least two samples: the mean number of samples (`repeats`), the mean within-example and the
+        between-example variance of is_correct, the fraction of examples answered correctly by every
+        sample (`all_correct`) and by at least one (`any_correct`), and the mean share of the most
+        common grade (`grade_consistency`) and, given the matching `responses`, of the most common
+        normalized answer (`answer_consistency`).
+        """
+        samples = {}
+        for i, grade in enumerate(grades):
+            samples.setdefault(record_example(grade), []).append(i)
+        samples = [indices for indices in samples.values() if len(indices) > 1]
+        if not samples:
+            return {}
+
+        def modal_share(values: List[str]) -> float:
+            return max(values.count(value) for value in set(values)) / len(values)
+
+        correct = [np.array([grades[i]["metrics"]["is_correct"] for i in indices], dtype=float) for indices in samples]
+        metrics = {
+            "repeated_examples": len(samples),
+            "repeats": float(np.mean([len(indices) for indices in samples])),
+            "is_correct:within_var": float(np.mean([c.var(ddof=1) for c in correct])),
+            "is_correct:between_var": float(np.var([c.mean() for c in correct], ddof=1)) if len(correct) > 1 else 0.0,
+            "all_correct": float(np.mean([c.all() for c in correct])),
+            "any_correct": float(np.mean([c.any() for c in correct])),
+            "grade_consistency": float(np.mean([
+                modal_share([grades[i]["grade"] for i in indices]) for indices in samples
+            ])),
         }
+        if responses is not None:
+            metrics["answer_consistency"] = float(np.mean([
+                modal_share([common.normalize_answer(responses[i].get("response", "")) for i in indices])
+                for indices in samples
+            ]))
+        return metrics
 
-        print(f"Accuracy Given Attempted: {output_d['accuracy_given_attempted']:.3f}")
-        print(f"F1 Score: {output_d['f1']:.3f}")
+    @staticmethod
+    def compare_grades(
+        baseline_grades: List[Dict],
+        grades: List[Dict],
+        n_bootstrap: int = 1000,
+        alpha: float = 0.05
+    ) -> Dict[str, float]:
+        """
+        Paired comparison of two runs over the examples graded in both (e.g. an int8 or bf16 model
+        against its fp32 baseline): each metric of both runs, their difference with a paired
+        bootstrap interval (`name:delta_ci_low`/`name:delta_ci_high`), and the grade agreement rate.
+        """
+        baseline = {record_key(grade): grade for grade in baseline_grades}
+        pairs = [(baseline[record_key(grade)], grade) for grade in grades if record_key(grade) in baseline]
+        assert pairs, "The two grades files have no examples in common"
+        # Columns: baseline is_correct, is_incorrect, then the same for the candidate
+        values = np.array([
+            [b["metrics"][name] for name in ("is_correct", "is_incorrect")]
+            + [c["metrics"][name] for name in ("is_correct", "is_incorrect")]
+            for b, c in pairs
+        ], dtype=float)
+        means = values.mean(axis=0)
+        baseline_metrics, candidate_metrics = simpleqa_metrics(*means[:2]), simpleqa_metrics(*means[2:])
 
-        return common.aggregate_results(results)
+        comparison = {"n_paired": len(pairs), "agreement": float(np.mean([b["grade"] == c["grade"] for b, c in pairs]))}
+        names = ("is_correct", "is_incorrect", "is_not_attempted", "accuracy_given_attempted", "f1")
+        for name in names:
+            comparison[f"{name}:baseline"] = float(baseline_metrics[name])
+            comparison[name] = float(candidate_metrics[name])
+            comparison[f"{name}:delta"] = float(candidate_metrics[name] - baseline_metrics[name])
+        if n_bootstrap:
+            # The same resampled rows for both runs, so the interval reflects the paired difference
+            resampled = common.bootstrap_means(values, n_bootstrap)
+            resampled_baseline = simpleqa_metrics(resampled[:, 0], resampled[:, 1])
+            resampled_candidate = simpleqa_metrics(resampled[:, 2], resampled[:, 3])
+            for name in names:
+                deltas = resampled_candidate[name] - resampled_baseline[name]
+                low, high = np.percentile(deltas, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+                comparison[f"{name}:delta_ci_low"] = float(low)
+                comparison[f"{name}:delta_ci_high"] = float(high)
+        return comparison
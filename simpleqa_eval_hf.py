@@ -1,141 +1,925 @@
-from hf_chat_completion_sampler import HFChatCompletionSampler
-from simpleqa_eval import SimpleQAEval
-import torch
+"""
+SimpleQA evaluation entry point.
+
+    python simpleqa_eval_hf.py generate  --model_name_hf <model> [options]
+    python simpleqa_eval_hf.py grade     --responses_file <file> --grader_model_name_hf <grader> [options]
+    python simpleqa_eval_hf.py grade     --responses_file <file> --grader_cascade <small> <large> [options]
+    python simpleqa_eval_hf.py run       --model_name_hf <model> --grader_model_name_hf <grader> [options]
+    python simpleqa_eval_hf.py report    --results_table <dir> | --responses_file <file> --grades_file <file>
+    python simpleqa_eval_hf.py aggregate --grades_file <file> [--responses_file <file>]
+    python simpleqa_eval_hf.py compare   --baseline_grades_file <file> --grades_file <file>
+    python simpleqa_eval_hf.py query     --tables <dir> [<dir> ...] [--by run] [--metrics ...]
+    python simpleqa_eval_hf.py daemon    [--max_resident_models <n>] [--status | --shutdown]
+
+Heavy modules (torch, transformers, the eval itself) are imported only by the subcommands that
+need them, so re-rendering a report or re-aggregating a grades file starts instantly. When a sampler
+daemon is running, local models are served by it instead of being loaded by every run.
+The legacy --generate_responses/--grade_responses flags are still accepted.
+"""
+import importlib
 import json
 import os
+import sys
+import time
+from argparse import ArgumentParser, Namespace
 from pathlib import Path
-from argparse import ArgumentParser
-import common
+from typing import Union
 
+_START = time.perf_counter()
+_import_times = {}
+_profile_printed = False
 
-def main():
-    parser = ArgumentParser()
-    # Response generation
-    parser.add_argument("--generate_responses", action="store_true", default=False)
-    parser.add_argument("--model_name_hf", type=str)
-    parser.add_argument("--model_dir", type=str, default=None)
-    parser.add_argument("--system_message", type=str, default=None)
-    parser.add_argument("--max_tokens", type=int, default=1024)
-    parser.add_argument("--temperature", type=float, default=0.7)
-    parser.add_argument("--device", type=str)
-    parser.add_argument("--num_examples", type=int, default=None)
 
-    # Response grading
-    parser.add_argument("--grade_responses", action="store_true", default=False)
-    parser.add_argument("--responses_file", type=Path)
-    parser.add_argument("--grader_model_name_hf", type=str)
-    parser.add_argument("--grader_model_dir", type=str, default=None)
-    parser.add_argument("--grader_max_tokens", type=int, default=1024)
-    parser.add_argument("--grader_temperature", type=float, default=0.7)
-    parser.add_argument("--grader_device", type=str)
+def _import(module: str):
+    """
+    Import `module` on first use, recording how long the import took for --profile-startup.
+    """
+    if module not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(module)
+        _import_times[module] = time.perf_counter() - start
+    return sys.modules[module]
 
-    parser.add_argument("--results_dir", type=Path, default=Path("results"))
-    args = parser.parse_args()
 
-    if not args.generate_responses and not args.grade_responses:
-        raise ValueError("Either --generate_responses or --grade_responses must be True")
+def _print_startup_profile(args):
+    global _profile_printed
+    if not args.profile_startup or _profile_printed:
+        return
+    _profile_printed = True
+    print("Startup import times:")
+    for module, seconds in sorted(_import_times.items(), key=lambda item: -item[1]):
+        print(f"  {module:<30} {seconds * 1000:8.1f} ms")
+    print(f"  {'total since start':<30} {(time.perf_counter() - _START) * 1000:8.1f} ms")
 
-    args.results_dir.mkdir(exist_ok=True)  # create results dir
-    responses = None
 
-    if args.generate_responses:
-        assert args.model_name_hf or args.model_dir, \
-            "model_name_hf or model_dir must be provided if --generate_responses is True"
+def _short_name(model_name_or_dir: str) -> str:
+    return model_name_or_dir.rstrip("/").split("/")[-1]
+
+
+def _unique_names(models_or_dirs: list) -> list:
+    """
+    Short names of several models. Names that clash get as many parent directories (or the hub
+    organization) as it takes to tell them apart, e.g. exp1/final and exp2/final become exp1-final
+    and exp2-final.
+    """
+    parts = [os.path.normpath(model).split("/") for model in models_or_dirs]
+    depths = [1] * len(parts)
+    while True:
+        names = ["-".join(part[-depth:]) for part, depth in zip(parts, depths)]
+        clashing = [i for i, name in enumerate(names) if names.count(name) > 1]
+        if not clashing:
+            return names
+        if all(depths[i] >= len(parts[i]) for i in clashing):
+            raise ValueError(f"Models given more than once: {models_or_dirs}")
+        for i in clashing:
+            depths[i] = min(depths[i] + 1, len(parts[i]))
+
+
+def _variant_name(model_name_or_dir: str, dtype: Union[str, None], quantize: Union[str, None]) -> str:
+    """
+    Short model name, suffixed with its quantization or dtype so reduced-precision runs get their own files.
+    """
+    suffix = quantize or dtype
+    return f"{_short_name(model_name_or_dir)}-{suffix}" if suffix else _short_name(model_name_or_dir)
+
+
+def _model_name(args) -> str:
+    # A sweep names each of its models so that their files never collide
+    name = getattr(args, "sweep_name", None) or args.model_name_hf or args.model_dir
+    return _variant_name(name, args.dtype, args.quantize)
+
+
+def _grader_name(args) -> str:
+    if args.grader_cascade:
+        cascade_name = "cascade-" + "+".join(_unique_names(args.grader_cascade))
+        return _variant_name(cascade_name, args.grader_dtype, args.grader_quantize)
+    return _variant_name(args.grader_model_name_hf or args.grader_model_dir, args.grader_dtype, args.grader_quantize)
+
+
+def _grader_label(args) -> str:
+    return args.grader_model_name_hf or args.grader_model_dir or " > ".join(args.grader_cascade)
+
+
+def _responses_file(args, model_name: str) -> Path:
+    if args.num_examples:
+        return args.results_dir / f"simpleqa_{model_name}_{args.num_examples}_responses.jsonl"
+    return args.results_dir / f"simpleqa_{model_name}_responses.jsonl"
+
+
+def _parse_responses_file(responses_file: Path):
+    """
+    Recover (model_name, num_examples) from a responses file name.
+    """
+    model_name = responses_file.name.split("_")[1]
+    num_examples = responses_file.name.split("_")[-2]
+    try:
+        num_examples = int(num_examples)
+    except ValueError:
+        num_examples = None  # contains all examples
+    return model_name, num_examples
+
+
+def _results_stem(args, model_name: str, grader_model_name: str, num_examples) -> Path:
+    if num_examples:
+        return args.results_dir / f"simpleqa_{model_name}_{grader_model_name}_{num_examples}"
+    return args.results_dir / f"simpleqa_{model_name}_{grader_model_name}"
+
+
+def _grades_file(results_stem: Path) -> Path:
+    return results_stem.with_name(results_stem.name + "_grades.jsonl")
+
+
+def _stem_from_grades_file(grades_file: Path) -> Path:
+    name = grades_file.name
+    for suffix in (".jsonl", ".json"):
+        name = name.removesuffix(suffix)
+    return grades_file.with_name(name.removesuffix("_grades"))
+
+
+def write_metrics(metrics: dict, results_stem: Path):
+    result_filename = results_stem.with_name(results_stem.name + ".json")
+    with open(result_filename, "w") as f:
+        f.write(json.dumps(metrics, indent=4))
+    print(f"Writing results to {result_filename}")
+
+    # Print results
+    print("\nResults:")
+    print(f"Accuracy (given attempted): {metrics['accuracy_given_attempted']:.3f}")
+    print("\nDetailed metrics:")
+    for k, v in metrics.items():
+        print(f"{k}: {v:.3f}")
+
+
+def write_html_report(
+    table_dir: Path, results_stem: Path, score, metrics: dict, report_page_size: Union[int, None], args=None
+):
+    """
+    Render the HTML report from a results table, one example at a time. With `args`, the startup
+    profile is printed once the report's modules are imported.
+    """
+    common = _import("common")
+    columnar = _import("columnar")
+    results_store = _import("results_store")
+    if args is not None:
+        _print_startup_profile(args)
+    htmls = results_store.example_htmls(columnar.read_table(table_dir))
+    if report_page_size:
+        report_filename = common.write_paginated_report(
+            results_stem.with_name(results_stem.name + "_report"), score, metrics, htmls, page_size=report_page_size
+        )
+        print(f"Wrote paginated report to {report_filename}")
+    else:
+        report_filename = results_stem.with_name(results_stem.name + ".html")
+        print(f"Writing report to {report_filename}")
+        with open(report_filename, "w") as fh:
+            common.write_report(fh, score=score, metrics=metrics, htmls=htmls)
+
 
-        model = HFChatCompletionSampler(
-            model=args.model_name_hf,
-            model_dir=args.model_dir,
-            API_TOKEN=os.environ.get("HF_TOKEN", None),
+def write_results(
+    eval_result,
+    results_stem: Path,
+    responses: list,
+    grades_file: Path,
+    report_page_size: Union[int, None] = None,
+    html: bool = True
+):
+    """
+    Write the results table of the graded responses, the metrics JSON and (with `html`) the report.
+    """
+    common = _import("common")
+    results_store = _import("results_store")
+    table_dir = results_store.write_results_table(
+        results_store.table_dir(results_stem), responses, common.read_jsonl(grades_file)
+    )
+    print(f"Wrote results table to {table_dir}")
+    if html:
+        write_html_report(table_dir, results_stem, eval_result.score, eval_result.metrics, report_page_size)
+
+    write_metrics(eval_result.metrics | {"score": eval_result.score}, results_stem)
+
+
+def _unload(sampler, name: str):
+    """
+    Free the sampler's model memory before the next model is loaded.
+    """
+    sampler.unload()
+    print(f"Model {name} unloaded")
+
+
+def _strip_arg(argv: list, flag: str) -> list:
+    i = argv.index(flag)
+    return argv[:i] + argv[i + 2:]
+
+
+def launch_and_merge(args):
+    """
+    Launcher mode: run this command once per shard in parallel workers, then merge their outputs.
+    """
+    sharding = _import("sharding")
+    argv = _strip_arg(sys.argv, "--launch_shards")
+    exit_codes = sharding.launch_shards(
+        argv, args.launch_shards, devices=args.shard_devices, cpu_sets=args.shard_cpu_sets
+    )
+    failed = [shard_id for shard_id, code in enumerate(exit_codes) if code != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed; rerun the same command to resume them")
+    merge(args, args.launch_shards)
+
+
+def merge(args, num_shards: int):
+    """
+    Merge per-shard responses/grades files into single files and write the metrics report.
+    """
+    sharding = _import("sharding")
+    if args.command in ("generate", "run"):
+        model_name = _model_name(args)
+        num_examples = args.num_examples
+        responses_file = sharding.merge_shards(_responses_file(args, model_name), num_shards)
+    else:
+        model_name, num_examples = _parse_responses_file(args.responses_file)
+        responses_file = args.responses_file
+
+    if args.command in ("grade", "run"):
+        grader_model_name = _grader_name(args)
+        results_stem = _results_stem(args, model_name, grader_model_name, num_examples)
+        grades_file = sharding.merge_shards(_grades_file(results_stem), num_shards)
+        # Every response is graded already, so no grader model is needed
+        write_report_from_files(args, responses_file, grades_file, results_stem, html=not args.no_report)
+
+
+def write_report_from_files(args, responses_file: Path, grades_file: Path, results_stem: Path, html: bool = True):
+    common = _import("common")
+    SimpleQAEval = _import("simpleqa_eval").SimpleQAEval
+    _print_startup_profile(args)
+
+    responses = list(common.load_records(responses_file))
+    eval_result = SimpleQAEval.evaluate(None, responses, grades_file=grades_file, n_bootstrap=args.n_bootstrap)
+    write_results(eval_result, results_stem, responses, grades_file, args.report_page_size, html)
+
+
+def _dispatch_shards(args) -> bool:
+    """
+    Handle the launcher and merge modes; returns True if the command was fully handled.
+    """
+    if args.launch_shards:
+        launch_and_merge(args)
+        return True
+    if args.merge_shards:
+        merge(args, args.merge_shards)
+        return True
+    return False
+
+
+def _is_remote(sampler) -> bool:
+    return hasattr(sampler, "latency_stats")
+
+
+def _load_local(args, config: dict, cpu_set: Union[str, None]):
+    """
+    Attach to the model in the sampler daemon if one is running, otherwise load it in this process.
+    `config` holds the HFChatCompletionSampler arguments.
+    """
+    sampler_daemon = _import("sampler_daemon")
+    if not args.no_daemon and sampler_daemon.daemon_running(args.daemon_socket):
+        _print_startup_profile(args)
+        # The daemon resolves paths from its own working directory
+        for key in ("model_dir", "profile_dir"):
+            if config.get(key):
+                config[key] = str(Path(config[key]).resolve())
+        # The draft model is a local directory or a hub name
+        if config.get("draft_model") and os.path.isdir(config["draft_model"]):
+            config["draft_model"] = str(Path(config["draft_model"]).resolve())
+        return sampler_daemon.DaemonSampler(config, args.daemon_socket)
+
+    _import("torch")
+    _import("transformers")
+    HFChatCompletionSampler = _import("hf_chat_completion_sampler").HFChatCompletionSampler
+    _print_startup_profile(args)
+
+    # Pinned before loading so torch's worker threads start on these cores
+    _import("sharding").pin_cpu_set(cpu_set)
+    return HFChatCompletionSampler(
+        **config,
+        API_TOKEN=os.environ.get("HF_TOKEN", None),
+        num_threads=args.num_threads,
+        num_interop_threads=args.num_interop_threads,
+        low_cpu_mem_usage=args.low_cpu_mem_usage
+    )
+
+
+def _load_model(args):
+    if args.api_base:
+        HTTPChatCompletionSampler = _import("http_chat_completion_sampler").HTTPChatCompletionSampler
+        _print_startup_profile(args)
+        return HTTPChatCompletionSampler(
+            model=args.model_name_hf or args.model_dir,
+            api_base=args.api_base,
             system_message=args.system_message,
             max_tokens=args.max_tokens,
             temperature=args.temperature,
-            device=args.device
+            max_concurrency=args.api_max_concurrency,
+            stop=args.stop
         )
 
-        print("Generating responses...")
-        responses = SimpleQAEval.generate_responses(model, num_examples=args.num_examples)
+    return _load_local(args, {
+        "model": args.model_name_hf,
+        "model_dir": args.model_dir,
+        "system_message": args.system_message,
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "device": args.device,
+        "batch_size": args.batch_size,
+        "sort_by_length": args.sort_by_length,
+        "stop": args.stop,
+        "stop_token_ids": args.stop_token_ids,
+        "profile_dir": args.profile_dir,
+        "profile_every": args.profile_every,
+        "dtype": args.dtype,
+        "quantize": args.quantize,
+        "draft_model": args.draft_model,
+    }, args.cpu_set)
 
-        print("Responses generated, writing to file...")
-        model_name = args.model_name_hf.split("/")[-1]
-        if args.num_examples:
-            responses_file = f"simpleqa_{model_name}_{args.num_examples}_responses.json"
+
+def _load_cascade(args):
+    """
+    The graders of --grader_cascade, cheapest first. Each is loaded (and wrapped for micro-batching)
+    only when the first response reaches its tier.
+    """
+    CascadeGrader = _import("cascade_grader").CascadeGrader
+
+    def loader(grader: str):
+        tier_args = Namespace(**vars(args))
+        tier_args.grader_cascade = None
+        if os.path.isdir(grader) and not args.grader_api_base:
+            tier_args.grader_model_name_hf, tier_args.grader_model_dir = None, grader
         else:
-            responses_file = f"simpleqa_{model_name}_responses.json"
-        responses_file = args.results_dir / responses_file
-
-        with open(responses_file, "w") as fh:
-            fh.write(json.dumps(responses, indent=4))
-        print(f"Model responses written to {responses_file}")
-
-        # Removing model from GPU memory
-        model.model = model.model.cpu()
-        del model
-        torch.cuda.empty_cache()
-        print(f"Model {args.model_name_hf} removed from GPU memory")
-
-    if args.grade_responses:
-        assert responses or args.responses_file, "responses_file must be provided if --grade_responses is True"
-        assert args.grader_model_name_hf or args.grader_model_dir, \
-            "grader_model_name_hf or grader_model_dir must be provided if --grade_responses is True"
-
-        if not responses:
-            responses = json.load(open(args.responses_file))
-            model_name = args.responses_file.name.split("/")[-1].split("_")[1]
-            num_examples = args.responses_file.name.split("/")[-1].split("_")[-2]
-            try:
-                num_examples = int(num_examples)
-            except ValueError:
-                num_examples = None  # contains all examples
-
-        # System message for the grader model is defined in simpleqa_eval.py
-        grader_model = HFChatCompletionSampler(
-            model=args.grader_model_name_hf,
-            model_dir=args.grader_model_dir,
-            API_TOKEN=os.environ.get("HF_TOKEN", None),
+            tier_args.grader_model_name_hf, tier_args.grader_model_dir = grader, None
+        return lambda: _wrap_grader(tier_args, _load_grader(tier_args))
+
+    def identity(grader: str) -> dict:
+        # What the tier's sampler will report once loaded, less the temperature (scoring ignores it)
+        if args.grader_api_base:
+            return {"model": grader, "url": args.grader_api_base.rstrip("/") + "/chat/completions"}
+        checkpoint = os.path.realpath(grader) if os.path.isdir(grader) else grader
+        return {"model": checkpoint, "dtype": args.grader_dtype, "quantize": args.grader_quantize}
+
+    return CascadeGrader(
+        [loader(grader) for grader in args.grader_cascade],
+        _unique_names(args.grader_cascade),
+        threshold=args.cascade_threshold,
+        audit_fraction=args.cascade_audit_fraction,
+        identities=[identity(grader) for grader in args.grader_cascade]
+    )
+
+
+def _load_grader(args):
+    if args.grader_cascade:
+        return _load_cascade(args)
+    if args.grader_api_base:
+        HTTPChatCompletionSampler = _import("http_chat_completion_sampler").HTTPChatCompletionSampler
+        _print_startup_profile(args)
+        return HTTPChatCompletionSampler(
+            model=args.grader_model_name_hf or args.grader_model_dir,
+            api_base=args.grader_api_base,
             max_tokens=args.grader_max_tokens,
             temperature=args.grader_temperature,
-            device=args.grader_device
+            max_concurrency=args.grader_api_max_concurrency
         )
 
-        # Evaluate responses
-        print("Evaluating responses...")
-        eval_result = SimpleQAEval.evaluate(grader_model, responses)
+    # System message for the grader model is defined in simpleqa_eval.py
+    return _load_local(args, {
+        "model": args.grader_model_name_hf,
+        "model_dir": args.grader_model_dir,
+        "max_tokens": args.grader_max_tokens,
+        "temperature": args.grader_temperature,
+        "device": args.grader_device,
+        "batch_size": args.grader_batch_size,
+        "dtype": args.grader_dtype,
+        "quantize": args.grader_quantize,
+    }, args.grader_cpu_set)
 
-        # Dump results to file
-        grader_model_name = args.grader_model_name_hf.split("/")[-1]
-        if args.num_examples:
-            html_file_name = Path(f"simpleqa_{model_name}_{grader_model_name}_{num_examples}.html")
-        else:
-            html_file_name = Path(f"simpleqa_{model_name}_{grader_model_name}.html")
-        report_filename = args.results_dir / html_file_name
 
-        print(f"Writing report to {report_filename}")
-        with open(report_filename, "w") as fh:
-            fh.write(common.make_report(eval_result))
+def _open_grade_cache(args):
+    if args.no_grade_cache:
+        return None
+    GradeCache = _import("grade_cache").GradeCache
+    return GradeCache(
+        args.grade_cache or args.results_dir / "grade_cache.sqlite",
+        max_entries=args.grade_cache_max_entries
+    )
+
+
+def _check_models(args, generation: bool, grading: bool):
+    if generation:
+        assert args.model_name_hf or args.model_dir, \
+            "model_name_hf or model_dir must be provided to generate responses"
+    if grading:
+        assert args.grader_model_name_hf or args.grader_model_dir or args.grader_cascade, \
+            "grader_model_name_hf, grader_model_dir or grader_cascade must be provided to grade responses"
 
-        metrics = eval_result.metrics | {"score": eval_result.score}
-        print(metrics)
-        if args.num_examples:
-            json_file_name = Path(f"simpleqa_{model_name}_{grader_model_name}_{num_examples}.json")
+
+def _output_files(args, model_name: str, num_examples):
+    """
+    Responses file, grades file and results stem of this run (per-shard files for shard workers).
+    """
+    sharding = _import("sharding")
+    # The grade subcommand reads an existing responses file instead
+    responses_file = _responses_file(args, model_name) if hasattr(args, "num_examples") else None
+    results_stem = None
+    grades_file = None
+    if any(getattr(args, name, None) for name in ("grader_model_name_hf", "grader_model_dir", "grader_cascade")):
+        grader_model_name = _grader_name(args)
+        results_stem = _results_stem(args, model_name, grader_model_name, num_examples)
+        grades_file = _grades_file(results_stem)
+    if args.num_shards > 1:
+        responses_file = responses_file and sharding.shard_path(responses_file, args.num_shards, args.shard_id)
+        grades_file = grades_file and sharding.shard_path(grades_file, args.num_shards, args.shard_id)
+    return responses_file, grades_file, results_stem
+
+
+def generate(args):
+    _check_models(args, generation=True, grading=False)
+    SimpleQAEval = _import("simpleqa_eval").SimpleQAEval
+    model = _load_model(args)
+
+    SimpleQAEval.load_dataset(args.dataset_path, args.dataset_cache_dir)
+    model_name = _model_name(args)
+    responses_file, _, _ = _output_files(args, model_name, args.num_examples)
+
+    print(f"Generating responses, streaming to {responses_file}...")
+    responses = SimpleQAEval.generate_responses(
+        model, num_examples=args.num_examples, n_repeats=args.n_repeats, output_file=responses_file,
+        num_shards=args.num_shards, shard_id=args.shard_id
+    )
+    print(f"Model responses written to {responses_file}")
+    if _is_remote(model):
+        print(f"Request latencies: {model.latency_stats()}")
+
+    # Removing model from GPU memory
+    _unload(model, args.model_name_hf or args.model_dir)
+    return responses, model_name, args.num_examples
+
+
+def _wrap_grader(args, grader_model):
+    """
+    Concurrent grading threads share a local model through a micro-batching scheduler.
+    A cascade wraps each of its graders as it loads them.
+    """
+    if _is_remote(grader_model) or isinstance(grader_model, _import("cascade_grader").CascadeGrader):
+        return grader_model
+    BatchingSampler = _import("batching_sampler").BatchingSampler
+    return BatchingSampler(grader_model, max_batch_size=args.grader_batch_size, max_wait_ms=args.grader_max_wait_ms)
+
+
+def grade(args, responses=None, model_name=None, num_examples=None, grader=None):
+    """
+    Grade and write the results. A `grader` passed in stays loaded; otherwise one is loaded and unloaded.
+    """
+    _check_models(args, generation=False, grading=True)
+    common = _import("common")
+    sharding = _import("sharding")
+    SimpleQAEval = _import("simpleqa_eval").SimpleQAEval
+    owns_grader = grader is None
+    if owns_grader:
+        grader = _wrap_grader(args, _load_grader(args))
+
+    sharded = args.num_shards > 1
+    if responses is None:
+        assert args.responses_file, "responses_file must be provided to grade responses"
+        responses = list(common.load_records(args.responses_file))
+        model_name, num_examples = _parse_responses_file(args.responses_file)
+        if sharded:
+            responses = sharding.shard(responses, args.num_shards, args.shard_id)
+
+    # Evaluate responses
+    _, grades_file, results_stem = _output_files(args, model_name, num_examples)
+    grade_cache = _open_grade_cache(args)
+
+    print(f"Evaluating responses, streaming grades to {grades_file}...")
+    eval_result = SimpleQAEval.evaluate(
+        grader, responses, grading_mode=args.grading_mode, grades_file=grades_file,
+        grade_cache=grade_cache, pregrade=args.pregrade, n_bootstrap=args.n_bootstrap
+    )
+    if grade_cache is not None:
+        grade_cache.close()
+    if _is_remote(grader):
+        eval_result.metrics.update({f"grader_{k}": v for k, v in grader.latency_stats().items()})
+
+    # Shard workers leave the report to the merge step
+    if not sharded:
+        write_results(eval_result, results_stem, responses, grades_file, args.report_page_size, not args.no_report)
+
+    # Removing grader model from GPU memory
+    if owns_grader:
+        _unload(grader, _grader_label(args))
+    return eval_result
+
+
+def run_pipelined(args):
+    """
+    Generate and grade at the same time, with both models loaded (on --device and --grader_device).
+    """
+    _check_models(args, generation=True, grading=True)
+    SimpleQAEval = _import("simpleqa_eval").SimpleQAEval
+    pipeline = _import("pipeline")
+    model = _load_model(args)
+    grader_model = _load_grader(args)
+
+    SimpleQAEval.load_dataset(args.dataset_path, args.dataset_cache_dir)
+    model_name = _model_name(args)
+    responses_file, grades_file, results_stem = _output_files(args, model_name, args.num_examples)
+    grade_cache = _open_grade_cache(args)
+
+    print(f"Generating and grading, streaming to {responses_file} and {grades_file}...")
+    responses = pipeline.run_pipelined(
+        model, grader_model, num_examples=args.num_examples, n_repeats=args.n_repeats,
+        responses_file=responses_file, grades_file=grades_file,
+        grading_mode=args.grading_mode, grade_cache=grade_cache, pregrade=args.pregrade,
+        num_shards=args.num_shards, shard_id=args.shard_id,
+        queue_size=args.pipeline_queue_size, grader_batch_size=args.grader_batch_size,
+        grader_max_wait_ms=args.grader_max_wait_ms, cpu_set=args.cpu_set, grader_cpu_set=args.grader_cpu_set
+    )
+
+    # Shard workers leave the report to the merge step
+    if args.num_shards == 1:
+        # Every response is graded already, so no grader model is needed
+        eval_result = SimpleQAEval.evaluate(
+            None, responses, grades_file=grades_file, grade_cache=grade_cache, n_bootstrap=args.n_bootstrap
+        )
+        write_results(eval_result, results_stem, responses, grades_file, args.report_page_size, not args.no_report)
+    if grade_cache is not None:
+        grade_cache.close()
+
+    _unload(model, args.model_name_hf or args.model_dir)
+    _unload(grader_model, _grader_label(args))
+
+
+def run_adaptive(args):
+    """
+    Evaluate examples in stratified random order until the metric's CI is narrow enough.
+    """
+    _check_models(args, generation=True, grading=True)
+    assert args.num_examples is None and args.n_repeats == 1 and args.num_shards == 1, \
+        "adaptive mode draws its own examples and cannot be combined with num_examples, n_repeats or sharding"
+    SimpleQAEval = _import("simpleqa_eval").SimpleQAEval
+    adaptive = _import("adaptive")
+    model = _load_model(args)
+    grader = _wrap_grader(args, _load_grader(args))
+
+    SimpleQAEval.load_dataset(args.dataset_path, args.dataset_cache_dir)
+    model_name = _model_name(args)
+    # Responses are shared with full runs; grades and results are kept apart
+    responses_file, _, results_stem = _output_files(args, model_name, None)
+    results_stem = results_stem.with_name(results_stem.name + "_adaptive")
+    grades_file = _grades_file(results_stem)
+    grade_cache = _open_grade_cache(args)
+
+    responses, sequential_metrics = adaptive.run_adaptive(
+        model, grader, target_half_width=args.target_half_width, metric=args.adaptive_metric,
+        look_size=args.look_size, budget=args.budget, alpha=args.adaptive_alpha,
+        responses_file=responses_file, grades_file=grades_file,
+        grading_mode=args.grading_mode, grade_cache=grade_cache, pregrade=args.pregrade
+    )
+    eval_result = SimpleQAEval.evaluate(
+        None, responses, grades_file=grades_file, grade_cache=grade_cache, n_bootstrap=args.n_bootstrap
+    )
+    eval_result.metrics.update(sequential_metrics)
+    write_results(eval_result, results_stem, responses, grades_file, args.report_page_size, not args.no_report)
+    if grade_cache is not None:
+        grade_cache.close()
+
+    _unload(model, args.model_name_hf or args.model_dir)
+    _unload(grader, _grader_label(args))
+
+
+def run(args):
+    if args.adaptive:
+        run_adaptive(args)
+        return
+    if args.pipeline:
+        run_pipelined(args)
+        return
+    responses, model_name, num_examples = generate(args)
+    grade(args, responses, model_name, num_examples)
+
+
+LEADERBOARD_COLUMNS = ["accuracy_given_attempted", "f1", "is_correct", "is_incorrect", "is_not_attempted"]
+
+
+def sweep(args):
+    """
+    Generate responses with each model in turn, then grade them all with one resident grader and
+    write a combined leaderboard.
+    """
+    _check_models(args, generation=False, grading=True)
+    common = _import("common")
+    SimpleQAEval = _import("simpleqa_eval").SimpleQAEval
+    SimpleQAEval.load_dataset(args.dataset_path, args.dataset_cache_dir)
+
+    runs = []
+    for candidate, name in zip(args.models, _unique_names(args.models)):
+        model_args = Namespace(**vars(args))
+        model_args.sweep_name = name
+        if os.path.isdir(candidate):
+            model_args.model_name_hf, model_args.model_dir = None, candidate
         else:
-            json_file_name = Path(f"simpleqa_{model_name}_{grader_model_name}.json")
-        result_filename = args.results_dir / json_file_name
-        with open(result_filename, "w") as f:
-            f.write(json.dumps(metrics, indent=4))
-        print(f"Writing results to {result_filename}")
-
-        # Print results
-        print("\nResults:")
-        print(f"Accuracy (given attempted): {eval_result.score:.3f}")
-        print("\nDetailed metrics:")
-        for k, v in eval_result.metrics.items():
-            print(f"{k}: {v:.3f}")
-
-        # Removing grader model from GPU memory
-        grader_model.model = grader_model.model.cpu()
-        del grader_model
-        torch.cuda.empty_cache()
-        print(f"Grader model {args.grader_model_name_hf} removed from GPU memory")
+            model_args.model_name_hf, model_args.model_dir = candidate, None
+        print(f"Sweep: generating with {candidate}")
+        runs.append((model_args, *generate(model_args)))
+
+    grader_model_name = _grader_name(args)
+    grader = _wrap_grader(args, _load_grader(args))
+    rows = []
+    for model_args, responses, model_name, num_examples in runs:
+        print(f"Sweep: grading {model_name}")
+        eval_result = grade(model_args, responses, model_name, num_examples, grader=grader)
+        results_stem = _results_stem(args, model_name, grader_model_name, num_examples)
+        report = f"{results_stem.name}_report/index.html" if args.report_page_size else f"{results_stem.name}.html"
+        rows.append({"model": model_name, "report": report, "metrics": eval_result.metrics})
+    _unload(grader, _grader_label(args))
+
+    rows.sort(key=lambda row: row["metrics"].get(args.leaderboard_metric, float("-inf")), reverse=True)
+    suffix = f"_{args.num_examples}" if args.num_examples else ""
+    leaderboard_stem = args.results_dir / f"leaderboard_{grader_model_name}{suffix}"
+    with open(leaderboard_stem.with_name(leaderboard_stem.name + ".json"), "w") as f:
+        f.write(json.dumps({"grader": grader_model_name, "sort_by": args.leaderboard_metric, "models": rows}, indent=4))
+    html_file = leaderboard_stem.with_name(leaderboard_stem.name + ".html")
+    with open(html_file, "w") as fh:
+        fh.write(common.make_leaderboard(rows, LEADERBOARD_COLUMNS, grader_model_name, args.leaderboard_metric))
+    print(f"Wrote leaderboard to {html_file}")
+
+    print(f"\nLeaderboard ({args.leaderboard_metric}):")
+    for rank, row in enumerate(rows, 1):
+        print(f"{rank:>3}. {row['model']:<40} {row['metrics'].get(args.leaderboard_metric, float('nan')):.3f}")
+
+
+def report(args):
+    if args.results_table:
+        # Metrics come from the run's metrics JSON, if it is there
+        results_stem = args.results_table.with_name(args.results_table.name.removesuffix("_table"))
+        metrics_file = results_stem.with_name(results_stem.name + ".json")
+        metrics = json.loads(metrics_file.read_text()) if metrics_file.exists() else {}
+        write_html_report(
+            args.results_table, results_stem, metrics.pop("score", None), metrics, args.report_page_size, args=args
+        )
+        return
+    assert args.responses_file and args.grades_file, \
+        "report needs --results_table, or --responses_file and --grades_file"
+    write_report_from_files(args, args.responses_file, args.grades_file, _stem_from_grades_file(args.grades_file))
+
+
+def query(args):
+    """
+    Mean metrics per run (or any other column) over the rows of one or more results tables.
+    """
+    results_store = _import("results_store")
+    _print_startup_profile(args)
+    columns = results_store.scan(args.tables, [args.by] + args.metrics)
+    groups = results_store.group_means(columns, args.by, args.metrics)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(groups, indent=4))
+        print(f"Writing query results to {args.output}")
+    width = max(len(label) for label in groups)
+    print(f"{args.by:<{width}} {'n':>7} " + " ".join(f"{name:>16}" for name in args.metrics))
+    for label, values in groups.items():
+        print(f"{label:<{width}} {values['n']:>7} " + " ".join(f"{values[name]:>16.4g}" for name in args.metrics))
+
+
+def aggregate(args):
+    common = _import("common")
+    SimpleQAEval = _import("simpleqa_eval").SimpleQAEval
+    _print_startup_profile(args)
+
+    grades = list(common.load_records(args.grades_file))
+    responses = list(common.load_records(args.responses_file)) if args.responses_file else None
+    metrics = SimpleQAEval.aggregate_grades(grades, responses, n_bootstrap=args.n_bootstrap)
+    write_metrics(metrics, _stem_from_grades_file(args.grades_file))
+
+
+def compare(args):
+    """
+    Paired metric deltas of a run against a baseline run (e.g. int8 or bf16 against fp32).
+    """
+    common = _import("common")
+    SimpleQAEval = _import("simpleqa_eval").SimpleQAEval
+    _print_startup_profile(args)
+
+    baseline_grades = list(common.load_records(args.baseline_grades_file))
+    grades = list(common.load_records(args.grades_file))
+    comparison = SimpleQAEval.compare_grades(baseline_grades, grades, n_bootstrap=args.n_bootstrap)
+    stem = _stem_from_grades_file(args.grades_file)
+    output_file = stem.with_name(f"{stem.name}_vs_{_stem_from_grades_file(args.baseline_grades_file).name}.json")
+    with open(output_file, "w") as f:
+        f.write(json.dumps(comparison, indent=4))
+    print(f"Writing comparison to {output_file}")
+
+    print(f"\nPaired examples: {comparison['n_paired']}, grade agreement: {comparison['agreement']:.3f}")
+    for name in ("is_correct", "accuracy_given_attempted", "f1"):
+        baseline, value, delta = (comparison[name + ":baseline"], comparison[name], comparison[name + ":delta"])
+        line = f"{name}: {baseline:.3f} -> {value:.3f} ({delta:+.3f}"
+        if args.n_bootstrap:
+            line += f", CI [{comparison[name + ':delta_ci_low']:+.3f}, {comparison[name + ':delta_ci_high']:+.3f}]"
+        print(line + ")")
+
+
+def daemon(args):
+    """
+    Serve models from a long-lived process, or query (--status) or stop (--shutdown) a running one.
+    """
+    sampler_daemon = _import("sampler_daemon")
+    if args.status or args.shutdown:
+        reply = sampler_daemon.request_daemon({"op": "status" if args.status else "shutdown"}, args.daemon_socket)
+        print(json.dumps(reply, indent=4))
+        # Return only once the daemon has stopped listening, so the next run loads its own models
+        while args.shutdown and sampler_daemon.daemon_running(args.daemon_socket):
+            time.sleep(0.1)
+        return
+
+    _import("torch")
+    _import("transformers")
+    _import("hf_chat_completion_sampler")
+    _print_startup_profile(args)
+    sampler_daemon.serve(args.daemon_socket, sampler_daemon.SamplerDaemon(
+        max_resident_models=args.max_resident_models,
+        low_cpu_mem_usage=args.low_cpu_mem_usage,
+        num_threads=args.num_threads,
+        num_interop_threads=args.num_interop_threads
+    ))
+
+
+COMMANDS = {
+    "generate": generate, "grade": grade, "run": run, "sweep": sweep, "report": report, "aggregate": aggregate,
+    "compare": compare, "query": query, "daemon": daemon
+}
+
+
+def _legacy_argv(argv: list) -> list:
+    """
+    Map the old flag-style invocation (--generate_responses/--grade_responses) onto a subcommand.
+    """
+    if not argv or argv[0] in COMMANDS or argv[0] in ("-h", "--help"):
+        return argv
+    generate_responses = "--generate_responses" in argv
+    grade_responses = "--grade_responses" in argv
+    if not generate_responses and not grade_responses:
+        raise ValueError(f"A subcommand ({', '.join(COMMANDS)}) or --generate_responses/--grade_responses is required")
+    argv = [arg for arg in argv if arg not in ("--generate_responses", "--grade_responses")]
+    command = "run" if generate_responses and grade_responses else "generate" if generate_responses else "grade"
+    return [command] + argv
+
+
+def build_parser() -> ArgumentParser:
+    common_args = ArgumentParser(add_help=False)
+    common_args.add_argument("--dataset_path", type=str, default=None)
+    common_args.add_argument("--dataset_cache_dir", type=Path, default=None)
+    common_args.add_argument("--results_dir", type=Path, default=Path("results"))
+    common_args.add_argument("--report_page_size", type=int, default=None)
+    common_args.add_argument("--n_bootstrap", type=int, default=1000)
+    common_args.add_argument("--profile-startup", dest="profile_startup", action="store_true", default=False)
+
+    # Response generation
+    generation_args = ArgumentParser(add_help=False)
+    generation_args.add_argument("--model_name_hf", type=str)
+    generation_args.add_argument("--model_dir", type=str, default=None)
+    generation_args.add_argument("--system_message", type=str, default=None)
+    generation_args.add_argument("--max_tokens", type=int, default=1024)
+    generation_args.add_argument("--temperature", type=float, default=0.7)
+    generation_args.add_argument("--device", type=str)
+    generation_args.add_argument("--num_examples", type=int, default=None)
+    generation_args.add_argument("--n_repeats", type=int, default=1)
+    generation_args.add_argument("--batch_size", type=int, default=1)
+    generation_args.add_argument("--no_sort_by_length", dest="sort_by_length", action="store_false", default=True)
+    generation_args.add_argument("--stop", type=str, action="append", default=None)
+    generation_args.add_argument("--stop_token_ids", type=int, nargs="+", default=None)
+    generation_args.add_argument("--profile_dir", type=Path, default=None)
+    generation_args.add_argument("--profile_every", type=int, default=100)
+    generation_args.add_argument("--api_base", type=str, default=None)
+    generation_args.add_argument("--api_max_concurrency", type=int, default=32)
+    generation_args.add_argument("--dtype", type=str, choices=["float32", "bfloat16", "float16"], default=None)
+    generation_args.add_argument("--quantize", type=str, choices=["int8"], default=None)
+    generation_args.add_argument("--cpu_set", type=str, default=None)
+    generation_args.add_argument("--draft_model", type=str, default=None)
+
+    # Response grading
+    grading_args = ArgumentParser(add_help=False)
+    grading_args.add_argument("--responses_file", type=Path)
+    grading_args.add_argument("--grader_model_name_hf", type=str)
+    grading_args.add_argument("--grader_model_dir", type=str, default=None)
+    grading_args.add_argument("--grader_max_tokens", type=int, default=1024)
+    grading_args.add_argument("--grader_temperature", type=float, default=0.7)
+    grading_args.add_argument("--grader_device", type=str)
+    grading_args.add_argument("--grader_batch_size", type=int, default=8)
+    grading_args.add_argument("--grader_max_wait_ms", type=float, default=10.0)
+    grading_args.add_argument("--grading_mode", type=str, choices=["generate", "logits"], default="generate")
+    grading_args.add_argument("--pregrade", action="store_true", default=False)
+    grading_args.add_argument("--grade_cache", type=Path, default=None)
+    grading_args.add_argument("--no_grade_cache", action="store_true", default=False)
+    grading_args.add_argument("--grade_cache_max_entries", type=int, default=1_000_000)
+    grading_args.add_argument("--grader_api_base", type=str, default=None)
+    grading_args.add_argument("--grader_api_max_concurrency", type=int, default=32)
+    grading_args.add_argument("--grader_dtype", type=str, choices=["float32", "bfloat16", "float16"], default=None)
+    grading_args.add_argument("--grader_quantize", type=str, choices=["int8"], default=None)
+    grading_args.add_argument("--grader_cpu_set", type=str, default=None)
+    grading_args.add_argument("--no_report", action="store_true", default=False)
+    grading_args.add_argument("--grader_cascade", type=str, nargs="+", default=None)
+    grading_args.add_argument("--cascade_threshold", type=float, default=0.9)
+    grading_args.add_argument("--cascade_audit_fraction", type=float, default=0.05)
+
+    # CPU thread pools and model loading, shared by every model of the process
+    runtime_args = ArgumentParser(add_help=False)
+    runtime_args.add_argument("--num_threads", type=int, default=None)
+    runtime_args.add_argument("--num_interop_threads", type=int, default=None)
+    runtime_args.add_argument("--low_cpu_mem_usage", action="store_true", default=False)
+    runtime_args.add_argument("--daemon_socket", type=Path, default=None)
+    runtime_args.add_argument("--no_daemon", action="store_true", default=False)
+
+    # Data-parallel sharding
+    shard_args = ArgumentParser(add_help=False)
+    shard_args.add_argument("--num_shards", type=int, default=1)
+    shard_args.add_argument("--shard_id", type=int, default=0)
+    shard_args.add_argument("--launch_shards", type=int, default=None)
+    shard_args.add_argument("--shard_devices", type=str, nargs="+", default=None)
+    shard_args.add_argument("--shard_cpu_sets", type=str, nargs="+", default=None)
+    shard_args.add_argument("--merge_shards", type=int, default=None)
+
+    parser = ArgumentParser(description="SimpleQA evaluation for Hugging Face models")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser(
+        "generate", parents=[common_args, generation_args, runtime_args, shard_args], help="generate responses"
+    )
+    subparsers.add_parser(
+        "grade", parents=[common_args, grading_args, runtime_args, shard_args], help="grade a responses file"
+    )
+    run_parser = subparsers.add_parser(
+        "run", parents=[common_args, generation_args, grading_args, runtime_args, shard_args],
+        help="generate, then grade"
+    )
+    run_parser.add_argument("--pipeline", action="store_true", default=False)
+    run_parser.add_argument("--pipeline_queue_size", type=int, default=64)
+    run_parser.add_argument("--adaptive", action="store_true", default=False)
+    run_parser.add_argument("--target_half_width", type=float, default=0.02)
+    run_parser.add_argument(
+        "--adaptive_metric", type=str, choices=["is_correct", "accuracy_given_attempted"], default="is_correct"
+    )
+    run_parser.add_argument("--look_size", type=int, default=200)
+    run_parser.add_argument("--budget", type=int, default=None)
+    run_parser.add_argument("--adaptive_alpha", type=float, default=0.05)
+    sweep_parser = subparsers.add_parser(
+        "sweep", parents=[common_args, generation_args, grading_args, runtime_args],
+        help="generate with several models, grade them with one grader and write a leaderboard"
+    )
+    sweep_parser.add_argument("--models", type=str, nargs="+", required=True)
+    sweep_parser.add_argument("--leaderboard_metric", type=str, default="f1")
+    sweep_parser.set_defaults(num_shards=1, shard_id=0)
+    report_parser = subparsers.add_parser(
+        "report", parents=[common_args], help="render the HTML report and metrics from existing files"
+    )
+    report_parser.add_argument("--results_table", type=Path, default=None)
+    report_parser.add_argument("--responses_file", type=Path, default=None)
+    report_parser.add_argument("--grades_file", type=Path, default=None)
+    aggregate_parser = subparsers.add_parser(
+        "aggregate", parents=[common_args], help="recompute the metrics JSON from a grades file"
+    )
+    aggregate_parser.add_argument("--grades_file", type=Path, required=True)
+    aggregate_parser.add_argument("--responses_file", type=Path, default=None)
+    compare_parser = subparsers.add_parser(
+        "compare", parents=[common_args], help="paired metric deltas of a grades file against a baseline"
+    )
+    compare_parser.add_argument("--baseline_grades_file", type=Path, required=True)
+    compare_parser.add_argument("--grades_file", type=Path, required=True)
+    query_parser = subparsers.add_parser(
+        "query", parents=[common_args], help="mean metrics per run (or other column) across results tables"
+    )
+    query_parser.add_argument("--tables", type=Path, nargs="+", required=True)
+    query_parser.add_argument("--by", type=str, default="run")
+    query_parser.add_argument(
+        "--metrics", type=str, nargs="+",
+        default=["is_correct", "is_incorrect", "is_not_attempted", "completion_tokens"]
+    )
+    query_parser.add_argument("--output", type=Path, default=None)
+    daemon_parser = subparsers.add_parser(
+        "daemon", parents=[common_args, runtime_args], help="keep models loaded and serve them to later runs"
+    )
+    daemon_parser.add_argument("--max_resident_models", type=int, default=2)
+    daemon_parser.add_argument("--status", action="store_true", default=False)
+    daemon_parser.add_argument("--shutdown", action="store_true", default=False)
+    return parser
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args(_legacy_argv(sys.argv[1:]))
+    # int8 dynamic quantization only handles float32 weights
+    for dtype, quantize in (("--dtype", "--quantize"), ("--grader_dtype", "--grader_quantize")):
+        dtype_value = getattr(args, dtype[2:], None)
+        if getattr(args, quantize[2:], None) and dtype_value not in (None, "float32"):
+            parser.error(f"{quantize} int8 cannot be combined with {dtype} {dtype_value}; use float32 or no {dtype}")
+    args.results_dir.mkdir(exist_ok=True)  # create results dir
+
+    if args.command in ("generate", "grade", "run") and _dispatch_shards(args):
+        return
+    COMMANDS[args.command](args)
 
 
 if __name__ == "__main__":
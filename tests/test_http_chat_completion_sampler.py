@@ -0,0 +1,162 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from http_chat_completion_sampler import HTTPChatCompletionSampler
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    OpenAI-compatible /v1/chat/completions stub. The first `failures` requests get the given status
+    codes, and every request is held `delay` seconds so concurrent requests overlap.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, failures=(), delay=0.0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.failures = list(failures)
+        self.delay = delay
+        self.payloads = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.payloads.append(payload)
+            failure = server.failures.pop(0) if server.failures else None
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            if failure:
+                self._reply(failure, {"error": "stub failure"})
+            elif payload.get("logprobs"):
+                top_logprobs = [
+                    {"token": "A", "logprob": math.log(0.6)},
+                    {"token": " B", "logprob": math.log(0.2)},
+                    {"token": "B", "logprob": math.log(0.1)},
+                    {"token": "The", "logprob": math.log(0.1)},
+                ]
+                self._reply(200, {"choices": [{"message": {"content": "A"}, "logprobs": {
+                    "content": [{"token": "A", "logprob": math.log(0.6), "top_logprobs": top_logprobs}]
+                }}], "usage": {"prompt_tokens": 5, "completion_tokens": 1}})
+            else:
+                content = payload["messages"][-1]["content"]
+                self._reply(200, {
+                    "choices": [{"message": {"content": f" echo: {content} "}}],
+                    "usage": {"prompt_tokens": 3, "completion_tokens": 2},
+                })
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@pytest.fixture
+def stub_server(request):
+    server = StubServer(**getattr(request, "param", {}))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_sampler(server: StubServer, **kwargs) -> HTTPChatCompletionSampler:
+    return HTTPChatCompletionSampler(model="stub", api_base=server.api_base, backoff=0.01, **kwargs)
+
+
+def test_completion(stub_server):
+    sampler = make_sampler(stub_server, system_message="Be brief.", stop=["\nUser:"])
+    try:
+        response = sampler([{"role": "user", "content": "hello"}])
+    finally:
+        sampler.close()
+    assert response.response_text == "echo: hello"
+    assert response.response_metadata["prompt_tokens"] == 3
+    assert response.response_metadata["completion_tokens"] == 2
+    payload = stub_server.payloads[0]
+    assert payload["messages"][0] == {"role": "system", "content": "Be brief."}
+    assert payload["stop"] == ["\nUser:"]
+
+
+@pytest.mark.parametrize("stub_server", [{"failures": [429, 503, 500]}], indirect=True)
+def test_retries_on_rate_limits_and_server_errors(stub_server):
+    sampler = make_sampler(stub_server, max_retries=3)
+    try:
+        response = sampler([{"role": "user", "content": "hello"}])
+        stats = sampler.latency_stats()
+    finally:
+        sampler.close()
+    assert response.response_text == "echo: hello"
+    assert len(stub_server.payloads) == 4
+    assert stats["retries"] == 3 and stats["requests"] == 1
+
+
+@pytest.mark.parametrize("stub_server", [{"failures": [503, 503]}], indirect=True)
+def test_gives_up_after_max_retries(stub_server):
+    sampler = make_sampler(stub_server, max_retries=1)
+    try:
+        with pytest.raises(Exception, match="503"):
+            sampler([{"role": "user", "content": "hello"}])
+    finally:
+        sampler.close()
+    assert len(stub_server.payloads) == 2
+
+
+def test_score_choices_from_top_logprobs(stub_server):
+    sampler = make_sampler(stub_server)
+    try:
+        probs = sampler.score_choices([{"role": "user", "content": "grade"}], ["A", "B", "C"])
+    finally:
+        sampler.close()
+    # " B" and "B" both count towards B; C is not among the top tokens
+    assert probs == pytest.approx([2 / 3, 1 / 3, 0.0])
+    payload = stub_server.payloads[0]
+    assert payload["max_tokens"] == 1 and payload["logprobs"] and payload["top_logprobs"] == 20
+
+
+def test_score_choices_metadata(stub_server):
+    sampler = make_sampler(stub_server)
+    try:
+        probs, metadata = sampler.score_choices_with_metadata([{"role": "user", "content": "grade"}], ["A", "B"])
+    finally:
+        sampler.close()
+    assert probs == pytest.approx([2 / 3, 1 / 3])
+    assert metadata["prompt_tokens"] == 5 and metadata["latency"] > 0
+
+
+@pytest.mark.parametrize("stub_server", [{"delay": 0.05}], indirect=True)
+def test_concurrency_limit(stub_server):
+    sampler = make_sampler(stub_server, max_concurrency=3)
+    message_lists = [[{"role": "user", "content": str(i)}] for i in range(12)]
+    try:
+        responses = sampler.sample_batch(message_lists)
+    finally:
+        sampler.close()
+    assert [response.response_text for response in responses] == [f"echo: {i}" for i in range(12)]
+    assert stub_server.max_in_flight == 3
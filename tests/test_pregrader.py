@@ -0,0 +1,51 @@
+import pytest
+
+from pregrader import pregrade
+
+
+@pytest.mark.parametrize("target, predicted_answer", [
+    ("32", "-32"),
+    ("4", "The answer is 4 km, 2 times"),
+    ("5", "COVID-19 had 5"),
+    ("Sasha", "Malia and Sasha"),
+    ("Blue", "It is blue and red"),
+    ("Blue", "Blue, red"),
+    ("Paris", "Paris or Lyon"),
+    ("50%", "-50%"),
+    ("Berlin", "I'm not sure. It is London."),
+    ("Munich", "I cannot confirm, it is Munich"),
+    ("Paris", "Paris Hilton"),
+    ("Leeds", "Leeds United"),
+    ("John Smith", "John Smith Jr."),
+    ("Michio Sugeno", "It was Michio Sugeno's student Takagi"),
+])
+def test_never_correct_for_wrong_or_ambiguous_answers(target, predicted_answer):
+    grade, _ = pregrade("question", target, predicted_answer)
+    assert grade != "A"
+
+
+@pytest.mark.parametrize("target, predicted_answer, expected", [
+    ("Paris", "Paris.", ("A", "rule:exact")),
+    ("Paris", "It is Paris.", ("A", "rule:contained")),
+    ("Simon and Garfunkel", "It was Simon and Garfunkel", ("A", "rule:contained")),
+    ("3.5", "3.5", ("A", "rule:exact")),
+    ("120k", "124,000", ("A", "rule:numeric")),
+    ("32", "-32", ("B", "rule:numeric")),
+    ("Malia and Sasha", "I don't know", ("C", "rule:refusal")),
+    ("Paris", "", ("C", "rule:empty")),
+])
+def test_decided_grades(target, predicted_answer, expected):
+    assert pregrade("question", target, predicted_answer) == expected
+
+
+def test_numeric_target_left_to_model_when_rule_abstains():
+    # A round gold number with an unequal answer has no known precision
+    assert pregrade("question", "1990", "1991") == (None, "model")
+
+
+@pytest.mark.parametrize("target, predicted_answer", [
+    ("Berlin", "I'm not sure. It is London."),
+    ("Munich", "I cannot confirm, it is Munich"),
+])
+def test_refusal_followed_by_an_answer_left_to_model(target, predicted_answer):
+    assert pregrade("question", target, predicted_answer) == (None, "model")